@@ -1,52 +1,66 @@
+import atexit
 import os
 import sys
 import platform
 import subprocess
 import json
-import logging
-from logging.handlers import RotatingFileHandler
-from aqt import mw
-from aqt.qt import QAction, QInputDialog
-from aqt.utils import showInfo
+import importlib
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from anki.utils import ids2str
+from aqt import gui_hooks, mw
+from aqt.operations import QueryOp
+from aqt.qt import QAction, QInputDialog, QProgressDialog, Qt, QTimer
+from aqt.utils import showInfo, tooltip
 
 addon_dir = os.path.abspath(os.path.dirname(__file__))
 log_path = os.path.join(addon_dir, "debug.log")
 
-# Set up rotating file handler with UTF-8 encoding
-handler = RotatingFileHandler(
-    log_path,
-    maxBytes=1024*1024,   # 1MB
-    backupCount=5,        # keep 5 backups
-    encoding="utf-8"      # IMPORTANT: allow emojis/non-ASCII
-)
-handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-logger.addHandler(handler)
+# The fetcher module, run in-process on background threads (see run_in_process).
+# It also owns the logging setup: queued, rotating, with LOG_LEVEL/LOG_JSON from config.json
+from . import magic_image_fetcher as fetcher
+
+fetcher.setup_logging(log_path)
+logger = fetcher.logger
+# Write out queued log records when Anki exits
+atexit.register(lambda: fetcher.stop_logging())
+
 
 def debug(msg):
     logger.debug(msg)
 
+
+def warning(msg):
+    logger.warning(msg)
+
+
+def error(msg):
+    logger.error(msg)
+
+
 # Test that logging works immediately
 debug("🔄 Starting Magic Image Fetcher")
 debug(f"📂 Log path: {log_path}")
 
-# Load config.json to check available API keys
-def get_available_sources():
+
+def load_config():
     config_path = os.path.join(os.path.dirname(__file__), "config.json")
     debug(f"📂 Config path: {config_path}")
     try:
         with open(config_path, "r") as f:
             config = json.load(f)
         debug(f"✅ Config loaded: {list(config.keys())}")
+        return config
     except Exception as e:
-        debug(f"⚠️ Failed to load config.json: {e}")
+        warning(f"⚠️ Failed to load config.json: {e}")
         showInfo(f"Error loading config.json: {e}")
-        return []
+        return None
 
+
+# Check which API keys are configured
+def get_available_sources(config):
     sources = []
     if config.get("PEXELS_API_KEY"):
         sources.append("Pexels")
@@ -54,33 +68,75 @@ def get_available_sources():
         sources.append("Unsplash")
     if config.get("SERPAPI_KEY"):
         sources.append("SerpAPI")
+    if config.get("LOCAL_LIBRARY_DIR"):
+        sources.append(LOCAL_OPTION)
     
     debug(f"✅ Available sources: {sources}")
     return sources
 
 
-def get_fields_for_deck(deck_name):
+# Source option that queries every configured provider and keeps the first result
+RACE_OPTION = "All sources (race)"
+# Source option for the LOCAL_LIBRARY_DIR image folder; it never takes part in a race
+LOCAL_OPTION = "Local"
+
+
+# deck name -> (collection modification time, ids of the note types used in the deck)
+_deck_note_types = {}
+
+
+def find_deck_note_type_ids(col, deck_name):
+    """Ids of the note types of every note in a deck, its subdecks, and filtered decks borrowing its cards."""
+    did = col.decks.id_for_name(deck_name)
+    if not did:
+        return []
+    dids = ids2str(col.decks.deck_and_child_ids(did))
+    return col.db.list(
+        f"select distinct n.mid from notes n join cards c on c.nid = n.id "
+        f"where c.did in {dids} or c.odid in {dids}"
+    )
+
+
+def load_deck_note_types(deck_name, on_done):
+    """Look up the deck's note types off the UI thread and pass their ids to on_done.
+
+    Results are cached per deck until the collection is modified.
+    """
+    cached = _deck_note_types.get(deck_name)
+    if cached and cached[0] == mw.col.mod:
+        debug(f"📥 Using cached note types for deck: {deck_name}")
+        on_done(cached[1])
+        return
+
+    def op(col):
+        return col.mod, find_deck_note_type_ids(col, deck_name)
+
+    def success(result):
+        _deck_note_types[deck_name] = result
+        debug(f"📥 Deck '{deck_name}' uses note types: {result[1]}")
+        on_done(result[1])
+
+    debug(f"📥 Looking up note types for deck: {deck_name}")
+    QueryOp(parent=mw, op=op, success=success).with_progress("Looking up note types…").run_in_background()
+
+
+def get_fields_for_deck(deck_name, note_type_ids):
     """Return the list of field names for the chosen deck's note type."""
     debug(f"📥 Fetching fields for deck: {deck_name}")
 
-    note_ids = mw.col.find_notes(f'deck:"{deck_name}"')
-    if not note_ids:
-        debug("⚠️ No notes found in deck")
+    if not note_type_ids:
+        warning("⚠️ No notes found in deck")
         showInfo("Selected deck has no notes.")
         return []
 
     models = {}
-    for nid in note_ids:
-        try:
-            note = mw.col.get_note(nid)
-            model = mw.col.models.get(note.mid)
-            if model:
-                models[note.mid] = model
-        except Exception as e:
-            debug(f"⚠️ Skipping note {nid}: {e}")
+    for mid in note_type_ids:
+        model = mw.col.models.get(mid)
+        if model:
+            models[mid] = model
 
     if not models:
-        debug("⚠️ No note types found for deck")
+        warning("⚠️ No note types found for deck")
         showInfo("Could not determine note type for this deck.")
         return []
 
@@ -100,7 +156,7 @@ def get_fields_for_deck(deck_name):
             False,
         )
         if not ok or not choice:
-            debug("❌ Note type selection cancelled")
+            error("❌ Note type selection cancelled")
             return []
         debug(f"✅ Note type selected: {choice}")
         selected_model = next(model for name, _, model in model_items if name == choice)
@@ -137,7 +193,7 @@ def choose_ordered_fields(fields, max_fields=3):
             if selected:
                 debug("✅ Field selection finished early by user")
                 break
-            debug("❌ Field selection cancelled")
+            error("❌ Field selection cancelled")
             return []
 
         selected.append(field)
@@ -147,13 +203,18 @@ def choose_ordered_fields(fields, max_fields=3):
     return selected
 
 
-def run_image_script():
-    debug("🚀 run_image_script() called")
+def run_image_script(mode="fetch"):
+    """Ask for a deck, fields and source, then fetch images, watch the deck ("watch") or check its links ("check_links")."""
+    debug(f"🚀 run_image_script(mode={mode}) called")
     
+    config = load_config()
+    if config is None:
+        return
+
     # Prompt for image source
-    source_options = get_available_sources()
+    source_options = get_available_sources(config)
     if not source_options:
-        debug("⚠️ No image sources configured in config.json.")
+        warning("⚠️ No image sources configured in config.json.")
         showInfo("No image sources configured in config.json. Please add API keys.")
         return
 
@@ -169,11 +230,21 @@ def run_image_script():
     # Show dropdown for deck selection
     deck_name, ok = QInputDialog.getItem(mw, "Select Deck", "Choose a deck:", deck_list, 0, False)
     if not ok or not deck_name.strip():
-        debug("❌ Deck selection cancelled")
+        error("❌ Deck selection cancelled")
         return
     debug(f"✅ Deck selected: {deck_name}")
 
-    available_fields = get_fields_for_deck(deck_name)
+    load_deck_note_types(
+        deck_name,
+        lambda note_type_ids: fetch_images_for_deck(
+            config, source_options, script_path, deck_name, note_type_ids, mode
+        ),
+    )
+
+
+def fetch_images_for_deck(config, source_options, script_path, deck_name, note_type_ids, mode="fetch"):
+    """Second half of run_image_script, once the deck's note types are known."""
+    available_fields = get_fields_for_deck(deck_name, note_type_ids)
     if not available_fields:
         return
 
@@ -186,11 +257,34 @@ def run_image_script():
     debug(f"✅ Search fields (ordered): {search_fields}")
 
     # Prompt for image source - use the available sources
+    # Race mode needs two sources with API keys; the local library is not raced
+    if len([source for source in source_options if source != LOCAL_OPTION]) > 1:
+        source_options.append(RACE_OPTION)
     source_choice, ok = QInputDialog.getItem(mw, "Image Source", "Choose an image source:", source_options, 0, False)
     if not ok or not source_choice:
-        debug("❌ Image source selection cancelled")
+        error("❌ Image source selection cancelled")
         return
     debug(f"✅ Image source selected: {source_choice}")
+    source_arg = "race" if source_choice == RACE_OPTION else source_choice.strip().lower()
+
+    script_args = [
+        f"--deck={deck_name.strip()}",
+        f"--fields={search_fields.strip()}",
+        f"--source={source_arg}",
+        "--resume",
+        "--progress",
+    ]
+
+    if mode == "watch":
+        # Watch mode relies on Anki's hooks, so it always runs in-process
+        start_watch(deck_name, script_args + ["--watch"])
+        return
+    if mode == "check_links":
+        script_args.append("--check-links")
+
+    if config.get("RUN_IN_PROCESS", True):
+        run_in_process(deck_name, script_args)
+        return
 
     debug(f"🚀 Launching script with deck={deck_name}, fields={search_fields}, source={source_choice}")
 
@@ -225,13 +319,7 @@ def run_image_script():
         debug(f"🖥️ {platform.system()} detected, using system python3")
 
     # Run the script with args
-    args = [
-        python_cmd,
-        script_path,
-        f"--deck={deck_name.strip()}",
-        f"--fields={search_fields.strip()}",
-        f"--source={source_choice.strip().lower()}"
-    ]
+    args = [python_cmd, script_path] + script_args
 
     debug(f"📝 Command: {' '.join(args)}")
 
@@ -243,19 +331,452 @@ def run_image_script():
         process = subprocess.Popen(
             args,
             shell=False,
-            stdout=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
             stderr=subprocess.DEVNULL,
             creationflags=creation_flags,
+            text=True,
+            encoding="utf-8",
+            errors="replace",
         )
         debug(f"✅ Subprocess launched successfully with PID: {process.pid}")
-        showInfo(f"Image fetching started! Check {log_path} for progress.")
+        events = queue.Queue()
+        reader = threading.Thread(target=read_process_events, args=(process, events), name="fetch-progress", daemon=True)
+        reader.start()
+
+        def stop():
+            debug(f"🛑 Cancelling fetcher (PID {process.pid})")
+            process.terminate()
+
+        # The run is over once the reader has queued everything the process printed, not when it exits:
+        # the process can exit before its last "done" line is read
+        show_fetch_progress(events, deck_name, reader.is_alive, stop)
     except Exception as e:
-        debug(f"❌ Failed to launch subprocess: {e}")
+        error(f"❌ Failed to launch subprocess: {e}")
         showInfo(f"Error launching subprocess: {e}")
 
+
+def run_on_main(fn, *args):
+    """Run fn on the main thread and wait for its result. Call only from background threads."""
+    future = Future()
+
+    def call():
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    mw.taskman.run_on_main(call)
+    return future.result()
+
+
+class CollectionBackend:
+    """Lets the in-process fetcher read and update notes through mw.col instead of AnkiConnect.
+
+    The fetcher calls these methods from its worker threads; each one hands
+    the collection work to the main thread. The note updates of a run are
+    merged into one undo entry for as long as it is the latest undoable step;
+    once the user does something undoable (the progress window does not
+    block them), later updates start a new entry, so undoing the run never
+    takes the user's own changes with it.
+    """
+
+    def __init__(self, undo_label="Fetch Images"):
+        self.undo_label = undo_label
+        self.undo_entry = None
+        self.changes = None
+
+    def find_notes(self, query):
+        return run_on_main(lambda: list(mw.col.find_notes(query)))
+
+    def notes_info(self, note_ids):
+        def load():
+            notes = []
+            for nid in note_ids:
+                try:
+                    note = mw.col.get_note(nid)
+                except Exception as e:
+                    warning(f"⚠️ Skipping note {nid}: {e}")
+                    continue
+                notes.append({
+                    "noteId": note.id,
+                    "modelName": note.note_type()["name"],
+                    "mod": note.mod,
+                    "tags": list(note.tags),
+                    "fields": {
+                        name: {"value": value, "order": order}
+                        for order, (name, value) in enumerate(note.items())
+                    },
+                })
+            return notes
+
+        return run_on_main(load)
+
+    def update_notes(self, updates):
+        """Apply (note_id, fields) updates in one call, returning an error or None for each."""
+        def write():
+            col = mw.col
+            notes = []
+            errors = []
+            for nid, fields in updates:
+                try:
+                    note = col.get_note(nid)
+                    for name, value in fields.items():
+                        note[name] = value
+                except Exception as e:
+                    errors.append(f"{type(e).__name__}: {e}")
+                    continue
+                notes.append(note)
+                errors.append(None)
+            if notes:
+                if self.undo_entry is None or col.undo_status().last_step != self.undo_entry:
+                    self.undo_entry = col.add_custom_undo_entry(self.undo_label)
+                col.update_notes(notes)
+                self.changes = col.merge_undo_entries(self.undo_entry)
+            return errors
+
+        return run_on_main(write)
+
+    def store_media(self, path, filename):
+        with open(path, "rb") as f:
+            data = f.read()
+        return run_on_main(lambda: mw.col.media.write_data(filename, data))
+
+    def media_dir(self):
+        return run_on_main(lambda: mw.col.media.dir())
+
+    def finish(self):
+        """Refresh open windows and the undo menu once the run is over. Main thread only."""
+        if self.changes is not None:
+            gui_hooks.operation_did_execute(self.changes, None)
+            mw.update_undo_actions()
+
+
+# Cancel event of the in-process run, or None when no run is active
+_in_process_cancel = None
+# Wake event of the running watch, or None when no deck is watched
+_watch_wake = None
+
+
+def reload_fetcher():
+    """Pick up config.json changes and start the fetcher from fresh module state."""
+    importlib.reload(fetcher)
+    fetcher.setup_logging(log_path)
+
+
+def warn_missing_pillow():
+    """Say so when settings that need Pillow are on, but Anki's own Python (used in-process) has no Pillow."""
+    if fetcher.Image is not None:
+        return
+    missing = []
+    if fetcher.RESIZE_IMAGES:
+        missing.append("image resizing (RESIZE_IMAGES)")
+    if fetcher.LOCAL_LIBRARY_DIR:
+        missing.append("keywords embedded in local library images")
+    if missing:
+        warning(f"⚠️ Pillow is not available in Anki's Python, skipping: {', '.join(missing)}")
+        tooltip(
+            f"Pillow is not available inside Anki, so {' and '.join(missing)} will be skipped. "
+            "Set RUN_IN_PROCESS to false to run the fetcher with a Python that has Pillow.",
+            period=8000,
+        )
+
+
+def run_in_process(deck_name, script_args):
+    """Run the fetcher on a background thread, using the collection directly."""
+    global _in_process_cancel
+    if _in_process_cancel is not None:
+        showInfo("Image fetching is already running. Wait for it to finish before starting another run.")
+        return
+
+    reload_fetcher()
+    warn_missing_pillow()
+    backend = CollectionBackend()
+    events = queue.Queue()
+    cancel_event = threading.Event()
+    finished = threading.Event()
+    _in_process_cancel = cancel_event
+
+    def task():
+        try:
+            fetcher.main(script_args, backend=backend, progress_sink=events.put, cancel_event=cancel_event)
+        except Exception as e:
+            error(f"❌ In-process fetch failed: {e}")
+            events.put({"event": "error", "message": str(e)})
+        finally:
+            finished.set()
+
+    def on_done(future):
+        global _in_process_cancel
+        _in_process_cancel = None
+        backend.finish()
+
+    debug(f"🚀 Running fetcher in-process with {' '.join(script_args)}")
+    mw.taskman.run_in_background(task, on_done)
+    show_fetch_progress(events, deck_name, lambda: not finished.is_set(), cancel_event.set)
+
+
+def reroll_selected_notes(browser):
+    """Give the selected notes the next image from their cached candidate pool."""
+    global _in_process_cancel
+    note_ids = list(browser.selected_notes())
+    if not note_ids:
+        tooltip("No notes selected.")
+        return
+    if _in_process_cancel is not None:
+        showInfo("Image fetching is already running. Wait for it to finish before rerolling.")
+        return
+
+    reload_fetcher()
+    backend = CollectionBackend("Reroll Image")
+    _in_process_cancel = threading.Event()
+    script_args = [f"--reroll={','.join(str(nid) for nid in note_ids)}"]
+
+    def on_done(future):
+        global _in_process_cancel
+        _in_process_cancel = None
+        backend.finish()
+        try:
+            counts = future.result() or {}
+        except Exception as e:
+            error(f"❌ Reroll failed: {e}")
+            showInfo(f"Reroll failed: {e}")
+            return
+        message = f"New image for {counts.get('rerolled', 0)} of {len(note_ids)} notes."
+        if counts.get("exhausted"):
+            message += f" {counts['exhausted']} had no more images."
+        if counts.get("unknown"):
+            message += f" {counts['unknown']} were not filled by this add-on (or were fetched without the cache)."
+        if counts.get("transient"):
+            message += f" {counts['transient']} failed, try again later."
+        tooltip(message, period=6000)
+
+    debug(f"🎲 Rerolling {len(note_ids)} notes")
+    mw.taskman.with_progress(
+        lambda: fetcher.main(script_args, backend=backend),
+        on_done,
+        label="Rerolling images…",
+    )
+
+
+def add_reroll_action(browser):
+    reroll_action = QAction("🎲 Reroll Image", browser)
+    reroll_action.triggered.connect(lambda: reroll_selected_notes(browser))
+    browser.form.menu_Notes.addAction(reroll_action)
+
+
+def start_watch(deck_name, script_args):
+    """Keep filling the deck's new and edited notes in the background until stop_watch()."""
+    global _in_process_cancel, _watch_wake
+    if _in_process_cancel is not None:
+        showInfo("Image fetching is already running. Wait for it to finish before watching a deck.")
+        return
+
+    reload_fetcher()
+    warn_missing_pillow()
+    backend = CollectionBackend()
+    cancel_event = threading.Event()
+    _in_process_cancel = cancel_event
+    _watch_wake = threading.Event()
+
+    def on_poll(event):
+        # Refresh the UI and start a new undo entry, so each poll can be undone on its own
+        backend.finish()
+        backend.undo_entry = None
+        backend.changes = None
+        if event.get("filled"):
+            tooltip(f"🖼️ Added pictures to {event['filled']} new notes in '{deck_name}'")
+
+    def on_event(event):
+        # Called on the fetcher's threads
+        if event.get("event") == "watch":
+            mw.taskman.run_on_main(lambda: on_poll(event))
+        elif event.get("event") == "error":
+            mw.taskman.run_on_main(lambda: showInfo(f"Watching '{deck_name}' stopped: {event.get('message')}"))
+
+    def task():
+        fetcher.main(script_args, backend=backend, progress_sink=on_event, cancel_event=cancel_event, wake_event=_watch_wake)
+
+    def on_done(future):
+        global _in_process_cancel, _watch_wake
+        _in_process_cancel = None
+        _watch_wake = None
+        watch_action.setText(WATCH_LABEL)
+        backend.finish()
+        try:
+            future.result()
+        except Exception as e:
+            error(f"❌ Watching failed: {e}")
+            showInfo(f"Watching '{deck_name}' failed: {e}")
+            return
+        tooltip(f"Stopped watching '{deck_name}'.")
+
+    debug(f"👀 Watching in-process with {' '.join(script_args)}")
+    watch_action.setText(f"🛑 Stop Watching '{deck_name}'")
+    mw.taskman.run_in_background(task, on_done)
+
+
+def stop_watch():
+    if _watch_wake is not None:
+        _in_process_cancel.set()
+        _watch_wake.set()
+
+
+def toggle_watch():
+    if _watch_wake is not None:
+        debug("🛑 Stopping watch")
+        stop_watch()
+    else:
+        run_image_script("watch")
+
+
+def wake_watch(note):
+    """Poll right away when a note is added, instead of waiting for the next interval."""
+    if _watch_wake is not None:
+        _watch_wake.set()
+
+
+def cancel_in_process_run():
+    if _in_process_cancel is not None:
+        debug("🛑 Profile closing, cancelling image fetching")
+        _in_process_cancel.set()
+        stop_watch()
+
+
+def read_process_events(process, events):
+    """Queue the JSON-lines events printed by a fetcher subprocess. Runs on a background thread."""
+    for line in process.stdout:
+        try:
+            events.put(json.loads(line))
+        except ValueError:
+            warning(f"⚠️ Unexpected fetcher output: {line.strip()}")
+    process.stdout.close()
+
+
+# Seconds without any event from the fetcher before it is reported as stalled
+STALL_SECONDS = 15
+
+# Keep a reference to every running progress tracker so Qt objects aren't garbage collected
+_active_fetches = []
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "–"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m" if hours else f"{minutes}m {seconds:02d}s"
+
+
+def format_progress(event):
+    lines = [
+        f"{event.get('done', 0)}/{event.get('total', 0)} notes · "
+        f"{event.get('rate', 0):.1f} notes/s · ETA {format_duration(event.get('eta'))}",
+        f"Images added: {event.get('filled', 0)} · No result: {event.get('no_result', 0)} · "
+        f"Errors: {event.get('transient', 0) + event.get('errors', 0)}",
+        f"Queue: {event.get('queue', 0)} · Cache hits: {event.get('cache_hits', 0)}",
+    ]
+    latency = event.get("latency_ms") or {}
+    if latency:
+        lines.append("Latency: " + ", ".join(f"{source} {ms} ms" for source, ms in sorted(latency.items())))
+    return "\n".join(lines)
+
+
+def show_fetch_progress(events, deck_name, is_running, stop):
+    """Show a non-blocking progress dialog fed by the fetcher's progress events.
+
+    events is a queue of event dicts, is_running tells whether the fetcher is
+    still working and stop asks it to stop.
+    """
+    dialog = QProgressDialog(f"Fetching images for '{deck_name}'…", "Cancel", 0, 0, mw)
+    dialog.setWindowTitle("Magic Image Fetcher")
+    dialog.setWindowModality(Qt.WindowModality.NonModal)
+    dialog.setMinimumDuration(0)
+    dialog.setMinimumWidth(420)
+    dialog.setAutoClose(False)
+    dialog.setAutoReset(False)
+    dialog.show()
+
+    timer = QTimer(mw)
+    state = {"last_event": time.monotonic(), "final": None, "label": "", "finished": False}
+    tracker = (dialog, timer)
+
+    def finish(message):
+        # Closing the dialog emits canceled(), so make sure this only runs once
+        if state["finished"]:
+            return
+        state["finished"] = True
+        timer.stop()
+        dialog.close()
+        if tracker in _active_fetches:
+            _active_fetches.remove(tracker)
+        debug(f"🏁 Fetch finished: {message}")
+        tooltip(message, period=6000)
+
+    def cancel():
+        if state["finished"]:
+            return
+        if is_running():
+            stop()
+        finish("Image fetching cancelled. Run it again to resume where it stopped.")
+
+    def poll():
+        while True:
+            try:
+                event = events.get_nowait()
+            except queue.Empty:
+                break
+            state["last_event"] = time.monotonic()
+            kind = event.get("event")
+            if kind == "phase":
+                state["label"] = event.get("phase", "")
+            elif kind in ("progress", "done"):
+                dialog.setMaximum(max(1, event.get("total", 0)))
+                dialog.setValue(min(event.get("done", 0), dialog.maximum()))
+                state["label"] = format_progress(event)
+                if kind == "done":
+                    state["final"] = event
+            elif kind == "error":
+                state["final"] = event
+
+        if not is_running() and events.empty():
+            final = state["final"] or {}
+            if final.get("event") == "error":
+                finish(f"Image fetching failed: {final.get('message')}")
+            elif final.get("message"):
+                finish(final["message"])
+            elif final:
+                finish(f"Image fetching finished: {final.get('filled', 0)} of {final.get('total', 0)} notes got a picture.")
+            else:
+                finish(f"Image fetcher stopped unexpectedly. Check {log_path} for details.")
+            return
+
+        stalled = time.monotonic() - state["last_event"]
+        label = state["label"]
+        if stalled > STALL_SECONDS:
+            label += f"\n⚠️ No progress reported for {int(stalled)}s"
+        dialog.setLabelText(label)
+
+    dialog.canceled.connect(cancel)
+    timer.timeout.connect(poll)
+    timer.start(250)
+    _active_fetches.append(tracker)
+
+gui_hooks.profile_will_close.append(cancel_in_process_run)
+gui_hooks.browser_menus_did_init.append(add_reroll_action)
+gui_hooks.add_cards_did_add_note.append(wake_watch)
+
 # Attach to Anki menu
 action = QAction("🖼️ Fetch Images", mw)
-action.triggered.connect(run_image_script)
+action.triggered.connect(lambda: run_image_script())
 mw.form.menuTools.addAction(action)
 
+WATCH_LABEL = "👀 Watch Deck for New Notes"
+watch_action = QAction(WATCH_LABEL, mw)
+watch_action.triggered.connect(toggle_watch)
+mw.form.menuTools.addAction(watch_action)
+
+check_links_action = QAction("🔗 Check Image Links", mw)
+check_links_action.triggered.connect(lambda: run_image_script("check_links"))
+mw.form.menuTools.addAction(check_links_action)
+
 debug("✅ Menu action attached successfully")
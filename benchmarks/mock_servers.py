@@ -0,0 +1,301 @@
+"""Local stand-ins for AnkiConnect and the image provider APIs, used by the benchmarks.
+
+Both servers run on background threads inside the benchmark process and keep
+simple counters so a run can be checked and measured afterwards.
+"""
+import base64
+import json
+import os
+import random
+import re
+import shutil
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class MockServer:
+    """Run a request handler class on a free localhost port in a daemon thread."""
+
+    def __init__(self, handler_class):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def mock(self):
+        return self.server.mock
+
+    def send_json(self, body, status=200, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+
+class _AnkiConnectHandler(_QuietHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        mock = self.mock
+        if mock.latency:
+            time.sleep(mock.latency)
+        try:
+            result = mock.handle(body["action"], body.get("params", {}))
+            self.send_json({"result": result, "error": None})
+        except Exception as e:
+            self.send_json({"result": None, "error": str(e)})
+
+
+class MockAnkiConnect(MockServer):
+    """AnkiConnect stand-in holding a deck of generated notes in memory.
+
+    Supports version, findNotes (honouring edited:N and Picture:_* terms), notesInfo,
+    updateNoteFields, multi, storeMediaFile and getMediaDirPath. Each note's
+    Front field is drawn from a vocabulary of `vocabulary` words, so decks with
+    a small vocabulary have many duplicate queries. add_notes() adds notes
+    while the server runs, e.g. to exercise watch mode.
+    """
+
+    def __init__(self, note_count, vocabulary, latency=0.0, media_dir=None, seed=1):
+        super().__init__(_AnkiConnectHandler)
+        self.rng = random.Random(seed)
+        self.vocabulary = vocabulary
+        self.latency = latency
+        self.media_dir = media_dir
+        self.lock = threading.Lock()
+        self.notes = {}
+        self.mod = {}
+        self.add_notes(note_count)
+        self.updated_at = {}
+        self.calls = {}
+
+    def add_notes(self, count):
+        """Add count generated notes with empty pictures, returning their ids."""
+        with self.lock:
+            first = len(self.notes) + 1
+            for note_id in range(first, first + count):
+                self.notes[note_id] = {
+                    "Front": f"word {self.rng.randrange(self.vocabulary)}",
+                    "Back": f"meaning {self.rng.randrange(self.vocabulary * 4)}",
+                    "Picture": "",
+                }
+                self.mod[note_id] = int(time.time())
+        return list(range(first, first + count))
+
+    def handle(self, action, params):
+        with self.lock:
+            self.calls[action] = self.calls.get(action, 0) + 1
+        if action == "version":
+            return 6
+        if action == "findNotes":
+            edited = re.search(r"\bedited:(\d+)", params.get("query", ""))
+            since = time.time() - int(edited.group(1)) * 86400 if edited else 0
+            # "Picture:_*" asks for notes that have a picture, "Picture:" for those without
+            with_picture = "Picture:_*" in params.get("query", "")
+            with self.lock:
+                return [
+                    note_id for note_id, fields in self.notes.items()
+                    if bool(fields["Picture"]) == with_picture and self.mod[note_id] >= since
+                ]
+        if action == "notesInfo":
+            return [self._note_info(note_id) for note_id in params["notes"] if note_id in self.notes]
+        if action == "updateNoteFields":
+            note = params["note"]
+            if note["id"] not in self.notes:
+                raise ValueError(f"note was not found: {note['id']}")
+            with self.lock:
+                self.notes[note["id"]].update(note["fields"])
+                self.mod[note["id"]] = int(time.time())
+                self.updated_at[note["id"]] = time.monotonic()
+            return None
+        if action == "multi":
+            results = []
+            for sub in params["actions"]:
+                try:
+                    results.append({"result": self.handle(sub["action"], sub.get("params", {})), "error": None})
+                except Exception as e:
+                    results.append({"result": None, "error": str(e)})
+            return results
+        if action == "storeMediaFile":
+            if self.media_dir:
+                target = os.path.join(self.media_dir, params["filename"])
+                if "path" in params:
+                    shutil.copyfile(params["path"], target)
+                elif "data" in params:
+                    with open(target, "wb") as f:
+                        f.write(base64.b64decode(params["data"]))
+            return params["filename"]
+        if action == "getMediaDirPath":
+            return self.media_dir
+        raise ValueError(f"unsupported action: {action}")
+
+    def _note_info(self, note_id):
+        fields = self.notes[note_id]
+        return {
+            "noteId": note_id,
+            "modelName": "Basic",
+            "mod": self.mod[note_id],
+            "tags": [],
+            "fields": {name: {"value": value, "order": order} for order, (name, value) in enumerate(fields.items())},
+        }
+
+
+class _ProviderHandler(_QuietHandler):
+    def do_GET(self):
+        mock = self.mock
+        url = urlparse(self.path)
+        if url.path.startswith("/images/"):
+            return self._send_image(url.path)
+
+        source = {"/v1/search": "pexels", "/search/photos": "unsplash", "/search": "serpapi"}.get(url.path)
+        if source is None:
+            return self.send_json({"error": "not found"}, status=404)
+
+        started = time.monotonic()
+        limited, headers = mock.take_quota()
+        if limited:
+            mock.count("429")
+            return self.send_json({"error": "rate limited"}, status=429, headers=headers)
+        if mock.latency:
+            time.sleep(max(0.0, mock.rng.gauss(mock.latency, mock.latency / 4)))
+        if mock.rng.random() < mock.error_rate:
+            mock.count("5xx")
+            return self.send_json({"error": "server error"}, status=503, headers=headers)
+
+        params = parse_qs(url.query)
+        query = (params.get("query") or params.get("q") or [""])[0]
+        if source == "serpapi":
+            per_page, offset = 100, 100 * int(params.get("ijn", ["0"])[0])
+        else:
+            per_page = int(params.get("per_page", ["1"])[0])
+            offset = per_page * (int(params.get("page", ["1"])[0]) - 1)
+        mock.count(source, time.monotonic() - started)
+        self.send_json(mock.search_response(source, query, per_page, offset), headers=headers)
+
+    def do_HEAD(self):
+        path = urlparse(self.path).path
+        if not path.startswith("/images/"):
+            return self.send_json({"error": "not found"}, status=404)
+        self._send_image(path, body=False)
+
+    def _send_image(self, path, body=True):
+        mock = self.mock
+        mock.count("image_head" if not body else "image_get")
+        if path in mock.dead_images:
+            return self.send_json({"error": "gone"}, status=404)
+        data = mock.image_bytes(path)
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+
+class MockImageProviders(MockServer):
+    """One server answering the Pexels, Unsplash and SerpAPI search endpoints.
+
+    latency is the mean response time in seconds, error_rate the share of
+    requests answered with HTTP 503, and rate_limit the number of requests
+    allowed per second before HTTP 429 responses (with Retry-After and
+    X-Ratelimit-* headers) are returned. Queries ending in a digit from
+    empty_digits get no results; every other query has results_per_query
+    images, served page by page. Image paths added to dead_images answer
+    HTTP 404, as expired CDN links do.
+    """
+
+    def __init__(self, latency=0.05, error_rate=0.0, rate_limit=None, empty_digits="7", image_size=50_000,
+                 results_per_query=12, seed=1):
+        super().__init__(_ProviderHandler)
+        self.results_per_query = results_per_query
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.empty_digits = empty_digits
+        self.image_size = image_size
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.counts = {}
+        self.latencies = []
+        self.dead_images = set()
+
+    def count(self, key, latency=None):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+            if latency is not None:
+                self.latencies.append(latency)
+
+    def take_quota(self):
+        if not self.rate_limit:
+            return False, {}
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= 1.0:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            remaining = max(0, self.rate_limit - self.window_count)
+            reset = time.time() + 1.0 - (now - self.window_start)
+        headers = {
+            "X-Ratelimit-Limit": self.rate_limit,
+            "X-Ratelimit-Remaining": remaining,
+            "X-Ratelimit-Reset": int(reset) + 1,
+        }
+        if self.window_count > self.rate_limit:
+            headers["Retry-After"] = 1
+            return True, headers
+        return False, headers
+
+    def search_response(self, source, query, per_page=1, offset=0):
+        count = 0 if query[-1:] in self.empty_digits else max(0, min(per_page, self.results_per_query - offset))
+        base = zlib.crc32(query.encode("utf-8")) % 100000
+        image_urls = [f"{self.url}/images/{base * 100 + offset + rank}.jpg" for rank in range(count)]
+        if source == "pexels":
+            photos = [{
+                "src": {"medium": image_url},
+                "photographer": "Mock Photographer",
+                "url": f"{self.url}/photographers/1",
+            } for image_url in image_urls]
+            return {"photos": photos}
+        if source == "unsplash":
+            results = [{
+                "urls": {"regular": image_url},
+                "user": {"name": "Mock Photographer", "links": {"html": f"{self.url}/photographers/1"}},
+            } for image_url in image_urls]
+            return {"results": results}
+        return {"images_results": [{"original": image_url} for image_url in image_urls]}
+
+    def image_bytes(self, path):
+        # Deterministic per path so repeated URLs have identical content
+        seed = int(os.path.splitext(os.path.basename(path))[0] or 0)
+        return random.Random(seed).getrandbits(self.image_size * 8).to_bytes(self.image_size, "little")
@@ -0,0 +1,188 @@
+"""Benchmark magic_image_fetcher.py against local mock AnkiConnect and provider servers.
+
+Each scenario copies the fetcher into a temporary add-on folder with a
+generated config.json pointing at the mock servers, runs it as a subprocess
+and reports notes per second, the p50/p99 latency of a provider search as
+the fetcher saw it (from its --profile-json output, so rate-limit waits and
+retries are included) and the fetcher's peak RSS. The JSON results also
+hold the mock server's own response times, to tell client overhead from
+provider latency.
+
+    python benchmarks/run_benchmarks.py                 # default scenarios
+    python benchmarks/run_benchmarks.py --scenario 10k  # one scenario
+    python benchmarks/run_benchmarks.py --all --json results.json
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # Windows: peak RSS is not reported
+    resource = None
+
+from mock_servers import MockAnkiConnect, MockImageProviders
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name: deck size, vocabulary size and mock provider behaviour
+SCENARIOS = {
+    "100": {"notes": 100, "vocabulary": 80},
+    "1k": {"notes": 1_000, "vocabulary": 600},
+    "10k": {"notes": 10_000, "vocabulary": 4_000},
+    "10k-flaky": {"notes": 10_000, "vocabulary": 4_000, "error_rate": 0.05},
+    "10k-429": {"notes": 10_000, "vocabulary": 4_000, "rate_limit": 200},
+    "1k-local-media": {"notes": 1_000, "vocabulary": 600, "args": ["--local-media"]},
+    "100k": {"notes": 100_000, "vocabulary": 20_000, "slow": True},
+}
+
+DEFAULTS = {
+    "latency": 0.05,
+    "error_rate": 0.0,
+    "rate_limit": None,
+    "workers": 16,
+    "args": [],
+}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def read_profile(path):
+    """Per-operation timings of the fetcher run that wrote the last line of a --profile-json file."""
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return {}
+    return json.loads(lines[-1])["timings"] if lines else {}
+
+
+def wait_with_rusage(process):
+    """Wait for the process and return its peak RSS in MB, if the platform reports it."""
+    if resource is None or not hasattr(os, "wait4"):
+        process.wait()
+        return None
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, "waitstatus_to_exitcode") else status
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return usage.ru_maxrss / divisor
+
+
+def run_scenario(name, scenario):
+    settings = dict(DEFAULTS, **scenario)
+    work_dir = tempfile.mkdtemp(prefix=f"mif-bench-{name}-")
+    media_dir = os.path.join(work_dir, "collection.media")
+    os.makedirs(media_dir)
+
+    anki = MockAnkiConnect(settings["notes"], settings["vocabulary"], media_dir=media_dir).start()
+    providers = MockImageProviders(
+        latency=settings["latency"],
+        error_rate=settings["error_rate"],
+        rate_limit=settings["rate_limit"],
+    ).start()
+    try:
+        shutil.copy(os.path.join(REPO_DIR, "magic_image_fetcher.py"), work_dir)
+        profile_path = os.path.join(work_dir, "profile.jsonl")
+        config = {
+            "PEXELS_API_KEY": "benchmark",
+            "ANKI_CONNECT_URL": anki.url,
+            "PEXELS_SEARCH_URL": f"{providers.url}/v1/search",
+            "UNSPLASH_SEARCH_URL": f"{providers.url}/search/photos",
+            "SERPAPI_SEARCH_URL": f"{providers.url}/search",
+            # Let the mock server, not the default quota, decide how fast we can go
+            "RATE_LIMITS": {"pexels": {"rate": 1000, "burst": 50}},
+            # Don't stop at the real free-tier quotas
+            "QUOTAS": {"pexels": {"hour": 0, "month": 0}},
+            "PROVIDER_CONCURRENCY": {"pexels": settings["workers"]},
+            "RETRY_BACKOFF_SECONDS": 0.1,
+        }
+        with open(os.path.join(work_dir, "config.json"), "w") as f:
+            json.dump(config, f)
+
+        command = [
+            sys.executable,
+            os.path.join(work_dir, "magic_image_fetcher.py"),
+            "--deck=Benchmark",
+            "--fields=Front,Back",
+            "--source=pexels",
+            f"--workers={settings['workers']}",
+            "--no-cache",
+            f"--profile-json={profile_path}",
+        ] + settings["args"]
+
+        started = time.monotonic()
+        process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        peak_rss = wait_with_rusage(process)
+        elapsed = time.monotonic() - started
+        if process.returncode:
+            print(process.stderr.read().decode("utf-8", "replace"), file=sys.stderr)
+        process.stderr.close()
+
+        search = read_profile(profile_path).get("search:pexels", {})
+        return {
+            "scenario": name,
+            "notes": settings["notes"],
+            "filled": len(anki.updated_at),
+            "elapsed_s": round(elapsed, 2),
+            "notes_per_s": round(settings["notes"] / elapsed, 1),
+            "search_p50_ms": search.get("p50_ms", 0.0),
+            "search_p99_ms": search.get("p99_ms", 0.0),
+            "server_p50_ms": round(percentile(providers.latencies, 50) * 1000, 1),
+            "server_p99_ms": round(percentile(providers.latencies, 99) * 1000, 1),
+            "peak_rss_mb": round(peak_rss, 1) if peak_rss is not None else None,
+            "provider_requests": dict(providers.counts),
+            "ankiconnect_calls": dict(anki.calls),
+            "exit_code": process.returncode,
+        }
+    finally:
+        anki.stop()
+        providers.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_table(results):
+    header = f"{'scenario':<16}{'notes':>8}{'filled':>8}{'secs':>9}{'notes/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'RSS MB':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        rss = f"{r['peak_rss_mb']:.1f}" if r["peak_rss_mb"] is not None else "n/a"
+        print(
+            f"{r['scenario']:<16}{r['notes']:>8}{r['filled']:>8}{r['elapsed_s']:>9.2f}"
+            f"{r['notes_per_s']:>10.1f}{r['search_p50_ms']:>9.1f}{r['search_p99_ms']:>9.1f}{rss:>8}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="Scenario to run (repeatable)")
+    parser.add_argument("--all", action="store_true", help="Include slow scenarios such as 100k notes")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    names = args.scenario or [name for name, s in SCENARIOS.items() if args.all or not s.get("slow")]
+    results = []
+    for name in names:
+        print(f"Running scenario {name}...", flush=True)
+        results.append(run_scenario(name, SCENARIOS[name]))
+
+    print()
+    print_table(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
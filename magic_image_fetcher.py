@@ -1,119 +1,578 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import argparse
+import base64
+import bisect
+import hashlib
+import heapq
+import html
+import math
+import mimetypes
+import tempfile
 import logging
+import random
+import sqlite3
+import re
+import sys
+import threading
 import time
+import queue
+import unicodedata
+import zlib
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from urllib.parse import unquote, urlparse
+from collections import namedtuple
+from itertools import chain
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 
-addon_dir = os.path.abspath(os.path.dirname(__file__))
-log_path = os.path.join(addon_dir, "debug.log")
-
-# Force unbuffered logging
-logging.basicConfig(
-    filename=log_path,
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    encoding='utf-8',   # IMPORTANT: avoid UnicodeEncodeError on macOS
-    force=True
-)
-
-# Get logger and add handler to force flush
-logger = logging.getLogger()
-for handler in logger.handlers:
-    handler.setLevel(logging.DEBUG)
-
-def debug(msg):
-    logging.debug(msg)
+try:
+    from PIL import Image, ImageOps, IptcImagePlugin
+except ImportError:
+    Image = ImageOps = IptcImagePlugin = None
 
-debug("🔄 Starting Magic Image Fetcher script")
-debug(f"📂 Log path: {log_path}")
+addon_dir = os.path.abspath(os.path.dirname(__file__))
+# Each process gets its own rotating log so two processes never rotate the same file:
+# the add-on (including in-process fetches) writes debug.log, and each script process
+# debug-script-<pid>.log, since add-on runs, link checks and runs by hand can overlap
+log_path = os.path.join(addon_dir, f"debug-script-{os.getpid()}.log")
+SCRIPT_LOG_RE = re.compile(r"^debug-script(-\d+)?\.log(\.\d+)?$")
+# Script logs not written to for this long are deleted when a script process starts
+SCRIPT_LOG_MAX_AGE_SECONDS = 7 * 24 * 3600
 
-# Load config.json
+# Load config.json (logged once logging is set up below)
 CONFIG_PATH = os.path.join(os.path.dirname(__file__), "config.json")
-debug(f"📂 Config path: {CONFIG_PATH}")
+config_error = None
 try:
     with open(CONFIG_PATH, "r") as f:
         config = json.load(f)
-    debug(f"✅ Config loaded successfully")
 except FileNotFoundError:
-    debug("❌ config.json not found. Please create it with your API keys.")
+    config_error = "config.json not found. Please create it with your API keys."
     config = {}
 except Exception as e:
-    debug(f"❌ Error loading config.json: {e}")
+    config_error = f"Error loading config.json: {e}"
     config = {}
 
-# Argument parsing
-parser = argparse.ArgumentParser()
-parser.add_argument("--deck", required=True)
-parser.add_argument("--fields", required=True)
-parser.add_argument("--source", required=False, default="pexels")
+LOG_LEVEL = str(config.get("LOG_LEVEL", "DEBUG")).upper()
+LOG_JSON = config.get("LOG_JSON", False)
+LOG_SAMPLE_RATE = config.get("LOG_SAMPLE_RATE", 1.0)
+LOG_MAX_BYTES = 1024 * 1024
+LOG_BACKUP_COUNT = 5
 
-try:
-    args = parser.parse_args()
-    debug(f"✅ Arguments parsed: deck={args.deck}, fields={args.fields}, source={args.source}")
-except Exception as e:
-    debug(f"❌ Error parsing arguments: {e}")
-    raise
+# Shared by the script and the add-on, which logs through the same logger
+logger = logging.getLogger("magic_image_fetcher")
+
+class JsonLinesFormatter(logging.Formatter):
+    """Format each record as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "process": record.process,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def setup_logging(path=log_path, level=LOG_LEVEL, json_lines=LOG_JSON):
+    """Send the shared logger's records through a queue to a rotating file.
+
+    Callers only put records on the queue; a QueueListener thread formats and
+    writes them, so the worker threads never wait on disk. Calling it again
+    (e.g. after the add-on reloads this module) replaces the previous setup.
+    """
+    for handler in list(logger.handlers):
+        if isinstance(handler, QueueHandler):
+            handler.listener.stop()
+            logger.removeHandler(handler)
+
+    file_handler = RotatingFileHandler(
+        path,
+        maxBytes=LOG_MAX_BYTES,
+        backupCount=LOG_BACKUP_COUNT,
+        encoding="utf-8",   # IMPORTANT: avoid UnicodeEncodeError on macOS
+    )
+    if json_lines:
+        file_handler.setFormatter(JsonLinesFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.listener = QueueListener(log_queue, file_handler)
+    queue_handler.listener.start()
+    logger.addHandler(queue_handler)
+    logger.setLevel(getattr(logging, level, logging.DEBUG))
+    logger.propagate = False
+
+def stop_logging():
+    """Flush queued records to disk and stop the listener thread."""
+    for handler in list(logger.handlers):
+        if isinstance(handler, QueueHandler):
+            handler.listener.stop()
+            logger.removeHandler(handler)
+
+def prune_script_logs(max_age=SCRIPT_LOG_MAX_AGE_SECONDS):
+    """Delete the logs (and rotated backups) of script processes that stopped writing max_age seconds ago."""
+    cutoff = time.time() - max_age
+    for name in os.listdir(addon_dir):
+        if SCRIPT_LOG_RE.match(name):
+            try:
+                if os.path.getmtime(os.path.join(addon_dir, name)) < cutoff:
+                    os.remove(os.path.join(addon_dir, name))
+            except OSError:
+                # Another process removed it first, or still has it open on Windows
+                pass
+
+def debug(msg):
+    logger.debug(msg)
+
+def info(msg):
+    logger.info(msg)
+
+def warning(msg):
+    logger.warning(msg)
+
+def error(msg):
+    logger.error(msg)
+
+_log_context = threading.local()
+
+def sample_note_logs(key):
+    """Decide whether the current thread logs per-note detail lines for the note (group) `key`.
 
-ANKI_CONNECT_URL = "http://localhost:8765"
-IMAGE_SOURCE = args.source.lower()
-DECK_NAME = args.deck
-SEARCH_FIELDS = [f.strip() for f in args.fields.split(",")]
+    The decision is a hash of the key, so a sampled note keeps every one of
+    its lines, and the same notes are sampled on every run.
+    """
+    _log_context.sampled = LOG_SAMPLE_RATE >= 1 or zlib.crc32(str(key).encode("utf-8")) % 10000 < LOG_SAMPLE_RATE * 10000
+
+def note_debug(msg, *args):
+    """Log a per-note detail line. Arguments are %-formatted only if the line is actually written."""
+    if getattr(_log_context, "sampled", LOG_SAMPLE_RATE >= 1) and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(msg, *args)
+
+# Only configure logging when run as a script: worker processes and
+# importers re-import this module and must not take over the log file.
+if __name__ == "__main__":
+    setup_logging()
+    prune_script_logs()
+
+debug("🔄 Starting Magic Image Fetcher script")
+debug(f"📂 Config path: {CONFIG_PATH}")
+if config_error:
+    error(f"❌ {config_error}")
+else:
+    debug("✅ Config loaded successfully")
+
+def parse_args(argv=None):
+    """Parse the command-line arguments passed by the add-on."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--deck")
+    parser.add_argument("--fields")
+    parser.add_argument("--source", required=False, default="pexels", help='Image source ("local" for LOCAL_LIBRARY_DIR), or "race" to query all configured sources')
+    parser.add_argument("--workers", type=int, required=False, default=config.get("WORKERS", 4))
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the search result cache")
+    parser.add_argument("--refresh", action="store_true", help="Ignore cached results but store the fresh ones")
+    parser.add_argument(
+        "--local-media",
+        action="store_true",
+        default=config.get("STORE_MEDIA_LOCALLY", False),
+        help="Download images into Anki's media folder instead of linking to them",
+    )
+    parser.add_argument(
+        "--progress",
+        action="store_true",
+        help="Write JSON-lines progress events to stdout",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the journal of the previous run and skip notes already known to have no image",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and fill notes as they are added or edited (implies --resume)",
+    )
+    parser.add_argument(
+        "--check-links",
+        action="store_true",
+        help="Check the images already in the deck and search again for notes whose image is gone",
+    )
+    parser.add_argument(
+        "--reroll",
+        metavar="NOTE_IDS",
+        help="Comma-separated note ids whose picture is replaced by the next cached candidate",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Only estimate the API calls, quota use and time the run needs, print them as JSON and exit",
+    )
+    parser.add_argument(
+        "--profile-json",
+        metavar="PATH",
+        help="Append this run's timing profile to PATH as one JSON line",
+    )
+    parser.add_argument(
+        "--rebuild-media-index",
+        action="store_true",
+        help="Re-hash the add-on's images in the media folder before running (with --local-media)",
+    )
+
+    try:
+        args = parser.parse_args(argv)
+        if not args.reroll and not (args.deck and args.fields):
+            parser.error("--deck and --fields are required unless --reroll is given")
+        if args.watch:
+            args.resume = True
+        debug(f"✅ Arguments parsed: deck={args.deck}, fields={args.fields}, source={args.source}, workers={args.workers}")
+    except Exception as e:
+        error(f"❌ Error parsing arguments: {e}")
+        raise
+    return args
+
+ANKI_CONNECT_URL = config.get("ANKI_CONNECT_URL", "http://localhost:8765")
+# Provider endpoints; overridable so the benchmarks can point them at local mock servers
+PEXELS_SEARCH_URL = config.get("PEXELS_SEARCH_URL", "https://api.pexels.com/v1/search")
+UNSPLASH_SEARCH_URL = config.get("UNSPLASH_SEARCH_URL", "https://api.unsplash.com/search/photos")
+SERPAPI_SEARCH_URL = config.get("SERPAPI_SEARCH_URL", "https://serpapi.com/search")
 PICTURE_FIELD = "Picture"
 REQUEST_TIMEOUT = (5, 30)
-REQUEST_PAUSE_SECONDS = 0.3
+USER_FILES_DIR = os.path.join(addon_dir, "user_files")
+CACHE_PATH = os.path.join(USER_FILES_DIR, "search_cache.sqlite3")
+CACHE_TTL_SECONDS = config.get("CACHE_TTL_DAYS", 30) * 86400
+CACHE_NEGATIVE_TTL_SECONDS = config.get("CACHE_NEGATIVE_TTL_DAYS", 7) * 86400
+CACHE_MAX_ENTRIES = config.get("CACHE_MAX_ENTRIES", 50000)
+MEDIA_UPLOAD_MODE = config.get("MEDIA_UPLOAD_MODE", "path")
+MEDIA_MAX_BYTES = config.get("MEDIA_MAX_MB", 15) * 1024 * 1024
+MEDIA_CHUNK_SIZE = 64 * 1024
+# Image downloads come from many hosts (each provider's CDN, SerpAPI's original sites),
+# so the download session keeps this many per-host pools instead of one
+MEDIA_HOST_POOLS = 16
+MEDIA_TMP_DIR = os.path.join(USER_FILES_DIR, "tmp")
+MEDIA_INDEX_PATH = os.path.join(USER_FILES_DIR, "media_index.sqlite3")
+JOURNAL_DIR = os.path.join(USER_FILES_DIR, "journals")
+RESIZE_IMAGES = config.get("RESIZE_IMAGES", False)
+IMAGE_MAX_SIZE = config.get("IMAGE_MAX_SIZE", 800)
+IMAGE_QUALITY = config.get("IMAGE_QUALITY", 80)
+IMAGE_FORMAT = config.get("IMAGE_FORMAT", "webp").lower()
+TRANSCODE_PROCESSES = config.get("TRANSCODE_PROCESSES") or None
+NOTES_PAGE_SIZE = max(1, config.get("NOTES_PAGE_SIZE", 500))
+WRITE_BATCH_SIZE = config.get("WRITE_BATCH_SIZE", 50)
+WRITE_BATCH_SECONDS = config.get("WRITE_BATCH_SECONDS", 2.0)
+HEDGE_DELAY_SECONDS = config.get("HEDGE_DELAY_SECONDS", 1.0)
+PROGRESS_INTERVAL_SECONDS = config.get("PROGRESS_INTERVAL_SECONDS", 1.0)
+# Link health scan (--check-links)
+LINK_CHECK_WORKERS = max(1, config.get("LINK_CHECK_WORKERS", 16))
+LINK_CHECK_TIMEOUT = (5, 10)
+# Watch mode polling interval: starts at the minimum and backs off while nothing changes
+WATCH_MIN_SECONDS = config.get("WATCH_MIN_SECONDS", 2.0)
+WATCH_MAX_SECONDS = max(WATCH_MIN_SECONDS, config.get("WATCH_MAX_SECONDS", 60.0))
+# Folder of the user's own images, searched by keyword before the providers (or alone with --source=local)
+LOCAL_LIBRARY_DIR = config.get("LOCAL_LIBRARY_DIR") or None
+LOCAL_LIBRARY_FIRST = config.get("LOCAL_LIBRARY_FIRST", True)
+LOCAL_LIBRARY_INDEX_PATH = os.path.join(USER_FILES_DIR, "local_library.sqlite3")
+# Images requested per search; the extras are kept in the cache for rerolls
+CANDIDATES_PER_QUERY = max(1, config.get("CANDIDATES_PER_QUERY", 5))
+
+# How field values become search queries, per note type name; "*" applies to every note type
+QUERY_RULES = {"*": {"furigana": "base", "remove": [], "shorten": True, "max_words": 3}}
+for _note_type, _rules in config.get("QUERY_RULES", {}).items():
+    QUERY_RULES.setdefault(_note_type, {}).update(_rules)
+
+# Maximum number of in-flight requests per provider, independent of WORKERS
+PROVIDER_CONCURRENCY = {"pexels": 4, "unsplash": 2, "serpapi": 2}
+PROVIDER_CONCURRENCY.update(config.get("PROVIDER_CONCURRENCY", {}))
+PROVIDER_SLOTS = {
+    source: threading.BoundedSemaphore(max(1, int(limit)))
+    for source, limit in PROVIDER_CONCURRENCY.items()
+}
+
+RETRY_ATTEMPTS = max(1, config.get("RETRY_ATTEMPTS", 3))
+RETRY_BACKOFF_SECONDS = config.get("RETRY_BACKOFF_SECONDS", 1.0)
+RETRY_MAX_BACKOFF_SECONDS = config.get("RETRY_MAX_BACKOFF_SECONDS", 30.0)
+CIRCUIT_FAILURE_THRESHOLD = config.get("CIRCUIT_FAILURE_THRESHOLD", 5)
+CIRCUIT_RESET_SECONDS = config.get("CIRCUIT_RESET_SECONDS", 60.0)
+
+# Token bucket settings per provider: sustained requests per second and burst size
+RATE_LIMITS = {
+    "pexels": {"rate": 5.0, "burst": 5},
+    "unsplash": {"rate": 2.0, "burst": 3},
+    "serpapi": {"rate": 2.0, "burst": 3},
+}
+for _source, _limits in config.get("RATE_LIMITS", {}).items():
+    RATE_LIMITS.setdefault(_source, {}).update(_limits)
+
+# API calls allowed per quota window ("hour" or "month") for each provider key; 0 or null stops tracking a window
+QUOTAS = {
+    "pexels": {"hour": 200, "month": 20000},
+    "unsplash": {"hour": 50},
+    "serpapi": {"month": 100},
+}
+for _source, _windows in config.get("QUOTAS", {}).items():
+    QUOTAS.setdefault(_source, {}).update(_windows)
+QUOTA_PATH = os.path.join(USER_FILES_DIR, "quota.sqlite3")
+# Longest a request waits for a used-up quota window to reset before it fails instead
+QUOTA_MAX_WAIT_SECONDS = config.get("QUOTA_MAX_WAIT_SECONDS", 3600)
+
+# Run settings, filled in from the command line by configure()
+args = None
+IMAGE_SOURCE = "pexels"
+DECK_NAME = None
+SEARCH_FIELDS = []
+WORKERS = 4
+LOCAL_MEDIA = False
+
+def configure(parsed_args):
+    """Apply parsed command-line arguments to the module's run settings."""
+    global args, IMAGE_SOURCE, DECK_NAME, SEARCH_FIELDS, WORKERS, LOCAL_MEDIA
+    args = parsed_args
+    IMAGE_SOURCE = args.source.lower()
+    DECK_NAME = args.deck
+    SEARCH_FIELDS = [f.strip() for f in (args.fields or "").split(",") if f.strip()]
+    WORKERS = max(1, args.workers)
+    LOCAL_MEDIA = args.local_media
+    debug(f"🎯 Settings: deck='{DECK_NAME}', fields={SEARCH_FIELDS}, source={IMAGE_SOURCE}, workers={WORKERS}")
+
+# Default headers set once on each provider's session
+SESSION_HEADERS = {
+    "pexels": {"Authorization": config.get("PEXELS_API_KEY") or ""},
+    "unsplash": {
+        "Accept-Version": "v1",
+        "Authorization": f"Client-ID {config.get('UNSPLASH_ACCESS_KEY') or ''}",
+    },
+    # Link checks should see what Anki's web view sees: hotlink and bot protection often refuse python-requests
+    "links": {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36",
+        "Accept": "image/avif,image/webp,image/apng,image/*,*/*;q=0.8",
+    },
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(name, pool_size=None, hosts=1):
+    """Return the shared keep-alive session for a host ("ankiconnect" or a provider name).
+
+    Each session keeps a connection pool sized so every worker, plus the
+    background note writer, can hold a connection without waiting, unless
+    pool_size says otherwise. hosts is the number of per-host pools kept.
+    """
+    with _sessions_lock:
+        session = _sessions.get(name)
+        if session is None:
+            pool_size = pool_size or WORKERS + 2
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=hosts, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update(SESSION_HEADERS.get(name, {}))
+            _sessions[name] = session
+            debug(f"🔗 Opened HTTP session for {name} (pool size {pool_size})")
+        return session
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+class Profiler:
+    """Thread-safe timings of run phases and external calls, reported at the end of the run.
+
+    Each timed operation is keyed by a name such as "ankiconnect:notesInfo",
+    "http:pexels" or "phase:process" and keeps its call count, total and
+    maximum time and a histogram over BUCKETS, updated as calls come in.
+    Percentiles come from a reservoir sample of at most SAMPLE_SIZE durations,
+    so a watch session that lasts all day uses no more memory than a short run.
+    """
+
+    # Upper bounds, in seconds, of the histogram buckets; slower calls fall in a last "inf" bucket
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    SAMPLE_SIZE = 2048
 
-debug(f"🎯 Settings: deck='{DECK_NAME}', fields={SEARCH_FIELDS}, source={IMAGE_SOURCE}")
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.started = time.monotonic()
+
+    @contextmanager
+    def timer(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - start)
+
+    def record(self, name, seconds):
+        with self.lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = {
+                    "count": 0, "total": 0.0, "max": 0.0,
+                    "buckets": [0] * (len(self.BUCKETS) + 1), "sample": [],
+                }
+            stats["count"] += 1
+            stats["total"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            stats["buckets"][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            sample = stats["sample"]
+            if len(sample) < self.SAMPLE_SIZE:
+                sample.append(seconds)
+            else:
+                # Reservoir sampling: every call so far has the same chance to be in the sample
+                index = random.randrange(stats["count"])
+                if index < self.SAMPLE_SIZE:
+                    sample[index] = seconds
+
+    def durations(self, name):
+        """Return (call count, sampled durations) for an operation."""
+        with self.lock:
+            stats = self.stats.get(name)
+            return (stats["count"], list(stats["sample"])) if stats else (0, [])
+
+    def summary(self):
+        """Per-operation statistics, sorted by name."""
+        with self.lock:
+            stats = {
+                name: dict(values, buckets=list(values["buckets"]), sample=list(values["sample"]))
+                for name, values in self.stats.items()
+            }
+        labels = [f"<={bound:g}s" for bound in self.BUCKETS] + ["inf"]
+        summary = {}
+        for name in sorted(stats):
+            values = stats[name]
+            sample = values["sample"]
+            summary[name] = {
+                "count": values["count"],
+                "total_s": round(values["total"], 3),
+                "mean_ms": round(values["total"] / values["count"] * 1000, 1),
+                "p50_ms": round(percentile(sample, 50) * 1000, 1),
+                "p90_ms": round(percentile(sample, 90) * 1000, 1),
+                "p99_ms": round(percentile(sample, 99) * 1000, 1),
+                "max_ms": round(values["max"] * 1000, 1),
+                "histogram": dict(zip(labels, values["buckets"])),
+            }
+        return summary
+
+    def log_summary(self, summary):
+        wall = time.monotonic() - self.started
+        info(f"⏱️ Timing profile ({wall:.1f}s wall clock; concurrent calls overlap, so totals can exceed it)")
+        info(f"⏱️ {'operation':<28}{'count':>8}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for name, stats in summary.items():
+            info(
+                f"⏱️ {name:<28}{stats['count']:>8}{stats['total_s']:>10.2f}{stats['mean_ms']:>10.1f}"
+                f"{stats['p50_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}"
+            )
+
+    def export_json(self, path, summary, **run_info):
+        """Append the profile as one JSON line, so repeated runs build a history to compare."""
+        record = dict(
+            run_info,
+            finished_at=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            wall_s=round(time.monotonic() - self.started, 3),
+            timings=summary,
+        )
+        try:
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+            info(f"⏱️ Timing profile appended to {path}")
+        except OSError as e:
+            error(f"❌ Could not write timing profile to {path}: {e}")
+
+PROFILER = Profiler()
+
+# Set by the add-on when running inside Anki: an object with find_notes,
+# notes_info, update_notes, store_media and media_dir methods that use the
+# collection directly. When None, everything goes through AnkiConnect.
+ANKI_BACKEND = None
+
+# The run's cancel event (see main). Long waits inside a search wait on it
+# instead of sleeping, so cancelling a run does not leave a worker asleep.
+CANCEL_EVENT = threading.Event()
+
+def backend_call(method, *args):
+    """Call a method of ANKI_BACKEND, timing it as "collection:<method>"."""
+    with PROFILER.timer(f"collection:{method}"):
+        return getattr(ANKI_BACKEND, method)(*args)
+
+def ankiconnect_post(payload):
+    """POST an AnkiConnect request on the shared session, timing it by action."""
+    with PROFILER.timer(f"ankiconnect:{payload['action']}"):
+        return get_session("ankiconnect").post(ANKI_CONNECT_URL, json=payload, timeout=REQUEST_TIMEOUT)
 
 def check_ankiconnect_available():
     """Check if AnkiConnect is responding before starting."""
+    if ANKI_BACKEND:
+        return True
     debug("🔌 Checking AnkiConnect availability...")
     try:
-        response = requests.post(
-            ANKI_CONNECT_URL,
-            json={"action": "version", "version": 6},
-            timeout=REQUEST_TIMEOUT
-        )
+        response = ankiconnect_post({"action": "version", "version": 6})
         if response.status_code == 200:
             version = response.json().get("result")
             debug(f"✅ AnkiConnect is available (version {version})")
             return True
         else:
-            debug(f"❌ AnkiConnect returned status {response.status_code}")
+            error(f"❌ AnkiConnect returned status {response.status_code}")
             return False
     except requests.exceptions.Timeout:
-        debug("❌ AnkiConnect connection timeout")
+        error("❌ AnkiConnect connection timeout")
         return False
     except requests.exceptions.ConnectionError as e:
-        debug(f"❌ Cannot connect to AnkiConnect: {e}")
+        error(f"❌ Cannot connect to AnkiConnect: {e}")
         return False
     except Exception as e:
-        debug(f"❌ Error checking AnkiConnect: {e}")
+        error(f"❌ Error checking AnkiConnect: {e}")
         return False
 
-def search_anki_for_empty_picture_notes():
-    debug(f"🔍 Searching for notes with empty {PICTURE_FIELD} field in deck '{DECK_NAME}'")
+def search_anki_for_empty_picture_notes(extra_terms=""):
+    """Return the ids of the deck's notes with an empty picture field, or None if the search failed.
+
+    extra_terms, such as "edited:1", are appended to the search to narrow it down.
+    """
+    debug(f"🔍 Searching for notes with empty {PICTURE_FIELD} field in deck '{DECK_NAME}' {extra_terms}")
+    return search_anki_for_notes(f'deck:"{DECK_NAME}" {PICTURE_FIELD}: {extra_terms}'.strip())
+
+def search_anki_for_notes(query):
+    """Return the ids of the notes matching an Anki search, or None if the search failed."""
     payload = {
         "action": "findNotes",
         "version": 6,
         "params": {
-            "query": f'deck:"{DECK_NAME}" {PICTURE_FIELD}:'
+            "query": query
         }
     }
     try:
-        response = requests.post(ANKI_CONNECT_URL, json=payload, timeout=REQUEST_TIMEOUT)
-        result = response.json()["result"]
-        debug(f"✅ Found {len(result)} notes with empty pictures")
+        if ANKI_BACKEND:
+            result = backend_call("find_notes", query)
+        else:
+            response = ankiconnect_post(payload)
+            result = response.json()["result"]
+        debug(f"✅ Found {len(result)} notes matching {query}")
         return result
     except requests.exceptions.Timeout:
-        debug("❌ Timeout searching notes via AnkiConnect")
-        return []
+        error("❌ Timeout searching notes via AnkiConnect")
+        return None
     except requests.exceptions.ConnectionError as e:
-        debug(f"❌ Connection error searching notes: {e}")
-        return []
+        error(f"❌ Connection error searching notes: {e}")
+        return None
     except Exception as e:
-        debug(f"❌ Error searching notes: {e}")
-        return []
+        error(f"❌ Error searching notes: {e}")
+        return None
 
 def get_notes_info(note_ids):
     debug(f"📥 Fetching info for {len(note_ids)} notes")
@@ -125,248 +584,2733 @@ def get_notes_info(note_ids):
         }
     }
     try:
-        response = requests.post(ANKI_CONNECT_URL, json=payload, timeout=REQUEST_TIMEOUT)
-        result = response.json()["result"]
+        if ANKI_BACKEND:
+            result = backend_call("notes_info", note_ids)
+        else:
+            response = ankiconnect_post(payload)
+            result = response.json()["result"]
         debug(f"✅ Retrieved info for {len(result)} notes")
         return result
     except requests.exceptions.Timeout:
-        debug("❌ Timeout getting notes info via AnkiConnect")
+        error("❌ Timeout getting notes info via AnkiConnect")
         return []
     except requests.exceptions.ConnectionError as e:
-        debug(f"❌ Connection error getting notes info: {e}")
+        error(f"❌ Connection error getting notes info: {e}")
         return []
     except Exception as e:
-        debug(f"❌ Error getting notes info: {e}")
+        error(f"❌ Error getting notes info: {e}")
         return []
 
+def normalize_query(query):
+    """Collapse whitespace and case so equivalent queries share a cache entry."""
+    return " ".join(query.split()).casefold()
+
+# Field markup stripped by QueryNormalizer, in the order it is applied
+SCRIPT_STYLE_RE = re.compile(r"<(script|style)\b[^>]*>.*?</\1\s*>", re.I | re.S)
+BLOCK_TAG_RE = re.compile(r"<br\s*/?>|</?(?:div|p|li|tr|td|h\d)\b[^>]*>", re.I)
+HTML_TAG_RE = re.compile(r"<[^>]*>")
+CLOZE_RE = re.compile(r"\{\{c\d+::(.*?)(?:::[^}]*)?\}\}", re.S)
+SOUND_RE = re.compile(r"\[sound:[^\]]*\]")
+# Anki's furigana syntax: "日本[にほん]", optionally preceded by a space separating it from earlier text
+FURIGANA_RE = re.compile(r" ?([^ >\[\]]+?)\[([^\]]+)\]")
+# Where a shortened query is cut: lists, alternatives, asides and dashes
+CLAUSE_BREAK_RE = re.compile(r"[,;/|()\[\]:]|\s[-–—]\s")
+
+class QueryNormalizer:
+    """Turn a raw field value into a search query using one note type's rules.
+
+    clean() strips script/style blocks, HTML tags and entities, cloze markers
+    (keeping the answer), sound references and furigana (keeping the base
+    text, or the reading when rules["furigana"] is "reading"), removes any
+    rules["remove"] patterns, then applies NFKC, casefolding and whitespace
+    collapsing. fallbacks() lists shorter queries to try when the full one
+    finds nothing.
+    """
+
+    def __init__(self, rules):
+        self.furigana = rules.get("furigana", "base")
+        self.remove = [re.compile(pattern, re.I) for pattern in rules.get("remove", [])]
+        self.shorten = rules.get("shorten", True)
+        self.max_words = max(0, rules.get("max_words", 3))
+
+    def clean(self, value):
+        text = SCRIPT_STYLE_RE.sub(" ", value)
+        text = BLOCK_TAG_RE.sub(" ", text)
+        text = HTML_TAG_RE.sub("", text)
+        text = html.unescape(text)
+        text = CLOZE_RE.sub(r"\1", text)
+        text = SOUND_RE.sub(" ", text)
+        if self.furigana == "reading":
+            text = FURIGANA_RE.sub(r"\2", text)
+        elif self.furigana == "base":
+            text = FURIGANA_RE.sub(r"\1", text)
+        for pattern in self.remove:
+            text = pattern.sub(" ", text)
+        text = unicodedata.normalize("NFKC", text).casefold()
+        return " ".join(text.split())
+
+    def fallbacks(self, query):
+        """Shorter variants of a cleaned query: its first clause, then its first max_words words."""
+        if not self.shorten:
+            return ()
+        variants = []
+        head = " ".join(CLAUSE_BREAK_RE.split(query, 1)[0].split())
+        if head and head != query:
+            variants.append(head)
+        words = (head or query).split()
+        if self.max_words and len(words) > self.max_words:
+            variants.append(" ".join(words[:self.max_words]))
+        return tuple(variants)
+
+_query_normalizers = {}
+
+def query_normalizer(note_type):
+    """Return the cached QueryNormalizer for a note type, merging its rules over the "*" defaults."""
+    normalizer = _query_normalizers.get(note_type)
+    if normalizer is None:
+        rules = dict(QUERY_RULES["*"], **QUERY_RULES.get(note_type, {}))
+        normalizer = _query_normalizers[note_type] = QueryNormalizer(rules)
+    return normalizer
+
+# One image search result, with the provider it came from
+Candidate = namedtuple("Candidate", ["image_url", "photographer", "photographer_url", "source"])
+
+class SearchCache:
+    """SQLite-backed cache of search results keyed by (source, normalized query).
+
+    Each search_results row records when a query was searched, with its best
+    image (or no image_url when the query returned nothing), and the full
+    ranked pool of candidates is kept in search_candidates. Negative entries
+    expire after a shorter TTL than positive ones. When the table grows past
+    max_entries the least recently used rows are evicted.
+
+    note_picks remembers which candidate each filled note got, so a reroll
+    can move the note to the next one without searching again.
+    """
+
+    def __init__(self, path, ttl, negative_ttl, max_entries, read=True):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.read = read
+        self.hits = 0
+        self.misses = 0
+        with self.lock, self.conn:
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS search_results (
+                    source TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    image_url TEXT,
+                    photographer TEXT,
+                    photographer_url TEXT,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (source, query)
+                )"""
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS search_results_last_used ON search_results (last_used)"
+            )
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS search_candidates (
+                    source TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    rank INTEGER NOT NULL,
+                    image_url TEXT NOT NULL,
+                    photographer TEXT,
+                    photographer_url TEXT,
+                    PRIMARY KEY (source, query, rank)
+                )"""
+            )
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS note_picks (
+                    note_id INTEGER PRIMARY KEY,
+                    source TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    rank INTEGER NOT NULL
+                )"""
+            )
+
+    def _load_pool(self, source, key, top):
+        """Ranked candidates of a cached query; top is its search_results row (image_url, photographer, photographer_url)."""
+        rows = self.conn.execute(
+            "SELECT image_url, photographer, photographer_url FROM search_candidates "
+            "WHERE source = ? AND query = ? ORDER BY rank",
+            (source, key),
+        ).fetchall()
+        if not rows and top and top[0]:
+            # Entry cached before candidate pools existed
+            rows = [top]
+        return [Candidate(*row, source) for row in rows]
+
+    def get(self, source, query):
+        """Return the cached list of Candidates (empty for a cached "no result"), or None on a miss."""
+        if not self.read:
+            return None
+        key = normalize_query(query)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT image_url, photographer, photographer_url, created FROM search_results "
+                "WHERE source = ? AND query = ?",
+                (source, key),
+            ).fetchone()
+            ttl = self.ttl if row and row[0] else self.negative_ttl
+            if row is None or now - row[3] > ttl:
+                self.misses += 1
+                return None
+            with self.conn:
+                self.conn.execute(
+                    "UPDATE search_results SET last_used = ? WHERE source = ? AND query = ?",
+                    (now, source, key),
+                )
+            self.hits += 1
+            return self._load_pool(source, key, row[:3])
+
+    def has(self, source, query):
+        """True if get() would answer the query from the cache, without counting a hit or miss."""
+        if not self.read:
+            return False
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT image_url IS NOT NULL, created FROM search_results WHERE source = ? AND query = ?",
+                (source, normalize_query(query)),
+            ).fetchone()
+        return row is not None and time.time() - row[1] <= (self.ttl if row[0] else self.negative_ttl)
+
+    def put(self, source, query, pool):
+        key = normalize_query(query)
+        top = pool[0][:3] if pool else (None, None, None)
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO search_results VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (source, key, *top, now, now),
+            )
+            self.conn.execute("DELETE FROM search_candidates WHERE source = ? AND query = ?", (source, key))
+            self.conn.executemany(
+                "INSERT INTO search_candidates VALUES (?, ?, ?, ?, ?, ?)",
+                [(source, key, rank, *candidate[:3]) for rank, candidate in enumerate(pool)],
+            )
+
+    def pool(self, source, query):
+        """All cached candidates of a query, expired or not (used for rerolls)."""
+        key = normalize_query(query)
+        with self.lock:
+            top = self.conn.execute(
+                "SELECT image_url, photographer, photographer_url FROM search_results "
+                "WHERE source = ? AND query = ?",
+                (source, key),
+            ).fetchone()
+            return self._load_pool(source, key, top)
+
+    def extend(self, source, query, candidates):
+        """Append newly fetched candidates to the end of a query's pool."""
+        key = normalize_query(query)
+        with self.lock, self.conn:
+            start = self.conn.execute(
+                "SELECT COALESCE(MAX(rank) + 1, 0) FROM search_candidates WHERE source = ? AND query = ?",
+                (source, key),
+            ).fetchone()[0]
+            self.conn.executemany(
+                "INSERT INTO search_candidates VALUES (?, ?, ?, ?, ?, ?)",
+                [(source, key, start + offset, *candidate[:3]) for offset, candidate in enumerate(candidates)],
+            )
+            self.conn.execute(
+                "UPDATE search_results SET last_used = ? WHERE source = ? AND query = ?",
+                (time.time(), source, key),
+            )
+
+    def forget_images(self, image_urls):
+        """Drop image URLs found dead from every pool; queries whose best image was one of them are searched again."""
+        image_urls = list(image_urls)
+        with self.lock, self.conn:
+            for start in range(0, len(image_urls), 500):
+                chunk = image_urls[start:start + 500]
+                marks = ",".join("?" * len(chunk))
+                self.conn.execute(f"DELETE FROM search_results WHERE image_url IN ({marks})", chunk)
+                self.conn.execute(f"DELETE FROM search_candidates WHERE image_url IN ({marks})", chunk)
+            self.conn.execute(
+                "DELETE FROM search_candidates WHERE NOT EXISTS ("
+                "SELECT 1 FROM search_results r WHERE r.source = search_candidates.source "
+                "AND r.query = search_candidates.query)"
+            )
+
+    def record_picks(self, note_ids, source, query, rank):
+        """Remember that these notes got candidate `rank` of the query's pool."""
+        key = normalize_query(query)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO note_picks VALUES (?, ?, ?, ?)",
+                [(note_id, source, key, rank) for note_id in note_ids],
+            )
+
+    def get_pick(self, note_id):
+        """Return (source, normalized query, rank) of the note's current image, or None."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT source, query, rank FROM note_picks WHERE note_id = ?", (note_id,)
+            ).fetchone()
+
+    def evict(self):
+        """Drop expired entries and trim the table to max_entries by least recent use."""
+        now = time.time()
+        with self.lock, self.conn:
+            expired = self.conn.execute(
+                "DELETE FROM search_results WHERE "
+                "(image_url IS NOT NULL AND created < ?) OR (image_url IS NULL AND created < ?)",
+                (now - self.ttl, now - self.negative_ttl),
+            ).rowcount
+            trimmed = self.conn.execute(
+                "DELETE FROM search_results WHERE rowid IN ("
+                "SELECT rowid FROM search_results ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+            if expired or trimmed:
+                self.conn.execute(
+                    "DELETE FROM search_candidates WHERE NOT EXISTS ("
+                    "SELECT 1 FROM search_results r WHERE r.source = search_candidates.source "
+                    "AND r.query = search_candidates.query)"
+                )
+        if expired or trimmed:
+            debug(f"🧹 Cache eviction: {expired} expired, {trimmed} least recently used")
+
+    def close(self):
+        self.evict()
+        with self.lock:
+            self.conn.close()
+
+SEARCH_CACHE = None
+
 def search_image_url(query):
-    debug(f"🔍 Searching image for query: '{query}' using source: {IMAGE_SOURCE}")
-    if IMAGE_SOURCE == "pexels":
-        return search_pexels(query)
-    elif IMAGE_SOURCE == "serpapi":
-        return search_serpapi(query), None, None
-    elif IMAGE_SOURCE == "unsplash":
-        return search_unsplash(query)
-    else:
-        debug("⚠️ Unknown image source. Defaulting to Pexels.")
-        return search_pexels(query)
+    """Return the ranked candidate pool for a query from the configured source (or race).
 
-def search_pexels(query):
+    With a local library, it is searched first (unless LOCAL_LIBRARY_FIRST is
+    off) and the providers are only asked when it has no matching image.
+    """
+    note_debug("🔍 Searching image for query: '%s' using source: %s", query, IMAGE_SOURCE)
+    if LOCAL_LIBRARY and (LOCAL_LIBRARY_FIRST or IMAGE_SOURCE == "local"):
+        pool = search_provider("local", query)
+        if pool:
+            LOCAL_LIBRARY.hits += 1
+            note_debug("🗂️ Local library has %s images for '%s'", len(pool), query)
+            return pool
+        LOCAL_LIBRARY.misses += 1
+    if IMAGE_SOURCE == "local":
+        return []
+    if IMAGE_SOURCE == "race":
+        return race_search(query)
+
+    source = IMAGE_SOURCE
+    if source not in PROVIDER_SLOTS:
+        warning("⚠️ Unknown image source. Defaulting to Pexels.")
+        source = "pexels"
+    return cached_search(source, query)
+
+def cached_search(source, query):
+    """Search one provider for a pool of candidates, answering from SEARCH_CACHE when possible.
+
+    Only answers are cached: a search that raised (see ProviderError) is tried again next time.
+    """
+    if SEARCH_CACHE:
+        with PROFILER.timer("cache:get"):
+            cached = SEARCH_CACHE.get(source, query)
+        if cached is not None:
+            note_debug("💾 Cache hit for '%s' (%s)", query, source)
+            return cached
+
+    pool = search_provider(source, query)
+
+    if SEARCH_CACHE:
+        SEARCH_CACHE.put(source, query, pool)
+    return pool
+
+def search_provider(source, query, offset=0):
+    """Call a provider's search API for CANDIDATES_PER_QUERY candidates starting at offset.
+
+    Returns a ranked list of Candidates (empty when nothing was found), timed
+    with retries included as "search:<source>". Raises TransientSearchError or
+    ProviderError when the provider could not answer. The local library is searched
+    in memory, without the provider slots, rate limits or quotas.
+    """
+    if source == "local":
+        with PROFILER.timer("search:local"):
+            return LOCAL_LIBRARY.search(query, CANDIDATES_PER_QUERY, offset) if LOCAL_LIBRARY else []
+    search = {"serpapi": search_serpapi, "unsplash": search_unsplash}.get(source, search_pexels)
+    with PROVIDER_SLOTS[source], PROFILER.timer(f"search:{source}"):
+        results = search(query, CANDIDATES_PER_QUERY, offset)
+    return [Candidate(url, photographer, photographer_url, source) for url, photographer, photographer_url in results]
+
+# Config key holding each provider's API key
+SOURCE_KEYS = {"pexels": "PEXELS_API_KEY", "unsplash": "UNSPLASH_ACCESS_KEY", "serpapi": "SERPAPI_KEY"}
+
+def available_sources():
+    """Providers with an API key configured, in SOURCE_PRIORITY order."""
+    priority = config.get("SOURCE_PRIORITY", ["pexels", "unsplash", "serpapi"])
+    return [source for source in priority if source in SOURCE_KEYS and config.get(SOURCE_KEYS[source])]
+
+# Files indexed by LocalLibrary, and the metadata it reads keywords from
+LIBRARY_IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp", ".svg", ".avif"}
+LIBRARY_SIDECAR_EXTENSIONS = (".txt", ".xmp")
+KEYWORD_RE = re.compile(r"[^\W_]+")
+XMP_SUBJECT_RE = re.compile(r"<dc:subject>(.*?)</dc:subject>", re.S)
+XMP_ITEM_RE = re.compile(r"<rdf:li\b[^>]*>([^<]*)</rdf:li>")
+# EXIF ImageDescription, XPTitle, XPKeywords and XPSubject; the XP tags are UTF-16 byte strings
+EXIF_KEYWORD_TAGS = (0x010E, 0x9C9B, 0x9C9E, 0x9C9F)
+# IPTC record 2, dataset 25: Keywords (repeatable)
+IPTC_KEYWORDS = (2, 25)
+
+def keyword_tokens(text):
+    """Split text into the casefolded words the local library is indexed and searched by."""
+    return set(KEYWORD_RE.findall(unicodedata.normalize("NFKC", text).casefold()))
+
+def xmp_subjects(xmp):
+    """The dc:subject keywords of an XMP packet."""
+    return [html.unescape(item) for subject in XMP_SUBJECT_RE.findall(xmp) for item in XMP_ITEM_RE.findall(subject)]
+
+def embedded_keywords(path):
+    """Keywords stored inside an image file: EXIF titles and keywords, IPTC keywords and XMP subjects.
+
+    Needs Pillow; without it, or for a file Pillow cannot read, returns nothing.
+    """
+    if Image is None:
+        return []
+    words = []
+    try:
+        with Image.open(path) as image:
+            exif = image.getexif()
+            for tag in EXIF_KEYWORD_TAGS:
+                value = exif.get(tag)
+                if isinstance(value, tuple):
+                    value = bytes(value)
+                if isinstance(value, bytes):
+                    value = value.decode("utf-16-le" if tag != 0x010E else "utf-8", "replace")
+                if isinstance(value, str):
+                    words.append(value.replace("\x00", " "))
+            keywords = (IptcImagePlugin.getiptcinfo(image) or {}).get(IPTC_KEYWORDS, [])
+            for keyword in keywords if isinstance(keywords, list) else [keywords]:
+                words.append(keyword.decode("utf-8", "replace"))
+            xmp = image.info.get("xmp") or image.info.get("XML:com.adobe.xmp")
+            if xmp:
+                words.extend(xmp_subjects(xmp.decode("utf-8", "replace") if isinstance(xmp, bytes) else xmp))
+    except Exception as e:
+        debug(f"🗂️ Could not read the metadata of {path}: {e}")
+    return words
+
+class LocalLibrary:
+    """Keyword index of the images in a folder, kept in SQLite between runs.
+
+    An image's keywords are the words of its path below the folder, of a
+    sidecar file next to it (<name>.txt with free-form tags, or <name>.xmp
+    whose dc:subject entries are used) and of the EXIF, IPTC and XMP keywords
+    embedded in it. update() walks the folder and only reads the files whose
+    size or modification time, or their sidecar's, changed since the last
+    run. The inverted index (keyword -> file ids) is held in memory, so a
+    search is a few set intersections and never touches the disk.
+    """
+
+    def __init__(self, path, root):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.root = os.path.abspath(root)
+        self.paths = []
+        self.keyword_counts = []
+        self.index = {}
+        self.hits = 0
+        self.misses = 0
+        with self.lock, self.conn:
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS library_files (
+                    path TEXT PRIMARY KEY,
+                    mtime REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    keywords TEXT NOT NULL
+                )"""
+            )
+
+    def scan(self):
+        """Yield (image path, modification time, size, sidecar paths) for every image below the folder."""
+        for folder, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+            names = set(filenames)
+            for name in filenames:
+                stem, extension = os.path.splitext(name)
+                if extension.lower() not in LIBRARY_IMAGE_EXTENSIONS:
+                    continue
+                sidecars = [
+                    os.path.join(folder, base + sidecar_extension)
+                    for base in (stem, name) for sidecar_extension in LIBRARY_SIDECAR_EXTENSIONS
+                    if base + sidecar_extension in names
+                ]
+                try:
+                    stat = os.stat(os.path.join(folder, name))
+                    mtime = max([stat.st_mtime] + [os.stat(sidecar).st_mtime for sidecar in sidecars])
+                except OSError:
+                    continue
+                yield os.path.join(folder, name), mtime, stat.st_size, sidecars
+
+    def read_keywords(self, path, sidecars):
+        words = [os.path.relpath(os.path.splitext(path)[0], self.root)]
+        for sidecar in sidecars:
+            try:
+                with open(sidecar, "r", encoding="utf-8", errors="replace") as f:
+                    text = f.read()
+            except OSError as e:
+                warning(f"⚠️ Could not read {sidecar}: {e}")
+                continue
+            words.extend(xmp_subjects(text) if sidecar.lower().endswith(".xmp") else [text])
+        words.extend(embedded_keywords(path))
+        return keyword_tokens(" ".join(words))
+
+    def update(self):
+        """Bring the index up to date with the folder and reload it into memory.
+
+        Returns (images indexed, images read again, images removed).
+        """
+        with self.lock:
+            known = {path: (mtime, size) for path, mtime, size in self.conn.execute(
+                "SELECT path, mtime, size FROM library_files"
+            )}
+        seen = set()
+        rows = []
+        for path, mtime, size, sidecars in self.scan():
+            seen.add(path)
+            if known.get(path) != (mtime, size):
+                rows.append((path, mtime, size, " ".join(sorted(self.read_keywords(path, sidecars)))))
+        removed = [(path,) for path in known if path not in seen]
+        with self.lock, self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO library_files VALUES (?, ?, ?, ?)", rows)
+            self.conn.executemany("DELETE FROM library_files WHERE path = ?", removed)
+        self.load()
+        return len(seen), len(rows), len(removed)
+
+    def load(self):
+        """Build the in-memory keyword index from the stored rows."""
+        with self.lock:
+            rows = self.conn.execute("SELECT path, keywords FROM library_files ORDER BY path").fetchall()
+        paths = []
+        keyword_counts = []
+        index = {}
+        for file_id, (path, keywords) in enumerate(rows):
+            keywords = keywords.split()
+            paths.append(path)
+            keyword_counts.append(len(keywords))
+            for keyword in keywords:
+                index.setdefault(keyword, set()).add(file_id)
+        # Swapped in one go so searches running meanwhile see either the old index or the new one
+        self.paths, self.keyword_counts, self.index = paths, keyword_counts, index
+
+    def search(self, query, count=None, offset=0):
+        """Return Candidates for the images having every word of the query as a keyword.
+
+        Images with fewer keywords rank first, as the query describes more of
+        them; ties keep path order so the ranking is stable between runs.
+        """
+        paths, keyword_counts, index = self.paths, self.keyword_counts, self.index
+        postings = sorted((index.get(token, ()) for token in keyword_tokens(query)), key=len)
+        matches = set(postings[0]) if postings else set()
+        for posting in postings[1:]:
+            if not matches:
+                break
+            matches &= posting
+        def rank(file_id):
+            return keyword_counts[file_id], file_id
+        if count is None:
+            ranked = sorted(matches, key=rank)[offset:]
+        else:
+            ranked = heapq.nsmallest(offset + count, matches, key=rank)[offset:]
+        return [Candidate(paths[file_id], None, None, "local") for file_id in ranked]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+LOCAL_LIBRARY = None
+
+def open_local_library():
+    """Open LOCAL_LIBRARY_DIR's index and bring it up to date, or return None when there is no usable library."""
+    if not LOCAL_LIBRARY_DIR:
+        return None
+    if not os.path.isdir(LOCAL_LIBRARY_DIR):
+        warning(f"⚠️ LOCAL_LIBRARY_DIR is not a folder, the local library is not searched: {LOCAL_LIBRARY_DIR}")
+        return None
+    try:
+        library = LocalLibrary(LOCAL_LIBRARY_INDEX_PATH, LOCAL_LIBRARY_DIR)
+        report("phase", phase="Indexing the local image library")
+        with PROFILER.timer("phase:index_library"):
+            total, changed, removed = library.update()
+    except Exception as e:
+        warning(f"⚠️ Could not index the local library, it is not searched: {e}")
+        return None
+    info(
+        f"🗂️ Local library: {total} images with {len(library.index)} keywords "
+        f"({changed} new or changed, {removed} removed)"
+    )
+    return library
+
+class RaceStats:
+    """Per-provider race wins, logged at the end of the run with each provider's search latency."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.races = 0
+        self.wins = {}
+
+    def record_race(self, winner):
+        with self.lock:
+            self.races += 1
+            if winner:
+                self.wins[winner] = self.wins.get(winner, 0) + 1
+
+    def log_summary(self):
+        for source in sorted(SOURCE_KEYS):
+            calls, values = PROFILER.durations(f"search:{source}")
+            if not calls:
+                continue
+            wins = self.wins.get(source, 0)
+            win_rate = f", won {wins}/{self.races} races ({wins / self.races:.0%})" if self.races else ""
+            info(
+                f"🏁 {source}: {calls} calls{win_rate}, latency "
+                f"p50={percentile(values, 50) * 1000:.0f}ms "
+                f"p90={percentile(values, 90) * 1000:.0f}ms "
+                f"p99={percentile(values, 99) * 1000:.0f}ms"
+            )
+
+RACE_STATS = RaceStats()
+RACE_SOURCES = []
+HEDGE_POOL = None
+
+def race_search(query):
+    """Hedged search across RACE_SOURCES; the first non-empty candidate pool wins.
+
+    The highest-priority provider is queried first. The next one is started
+    when the current leader has not answered within HEDGE_DELAY_SECONDS, or as
+    soon as a provider comes back empty. Once a provider returns an image the
+    remaining requests are cancelled; requests already on the wire are left to
+    finish in the background so their answers still reach the cache.
+    """
+    remaining = iter(RACE_SOURCES)
+    pending = {}
+    failure = None
+
+    def launch_next():
+        source = next(remaining, None)
+        if source:
+            note_debug("🏁 Racing '%s' on %s", query, source)
+            pending[HEDGE_POOL.submit(cached_search, source, query)] = source
+
+    launch_next()
+    while pending:
+        done, _ = wait(pending, timeout=HEDGE_DELAY_SECONDS, return_when=FIRST_COMPLETED)
+        if not done:
+            launch_next()
+            continue
+        for future in done:
+            source = pending.pop(future)
+            try:
+                result = future.result()
+            except (TransientSearchError, ProviderError) as e:
+                failure = e
+                continue
+            if result:
+                for other in pending:
+                    other.cancel()
+                RACE_STATS.record_race(source)
+                note_debug("🏆 %s won the race for '%s'", source, query)
+                return result
+        launch_next()
+
+    RACE_STATS.record_race(None)
+    if failure:
+        # A source that failed might have had an image: this is not a "no result"
+        raise failure
+    return []
+
+def parse_retry_after(value):
+    """Return the number of seconds to wait for a Retry-After header value, or None."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    """Token bucket for one provider that adapts to the provider's rate-limit headers.
+
+    The refill rate starts at the configured maximum. Low ``X-Ratelimit-Remaining``
+    values spread the remaining quota over the time left until the reset, and 429
+    responses halve the rate and pause the bucket for ``Retry-After`` seconds.
+    Successful responses with plenty of quota left ramp the rate back up.
+    Headers whose reset is further away than QUOTA_WINDOW_SECONDS describe a
+    longer quota (Pexels reports its monthly one); those are left to QuotaLedger.
+    """
+
+    MIN_RATE = 0.01
+    QUOTA_WINDOW_SECONDS = 3600
+    LOW_QUOTA_FRACTION = 0.1
+
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.max_rate = max(self.MIN_RATE, float(rate))
+        self.rate = self.max_rate
+        self.capacity = max(1.0, float(burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, cancel_event=None):
+        """Block until a request may be sent to the provider.
+
+        A quota pause can last until the provider's reset, so the wait ends
+        early with TransientSearchError when cancel_event is set.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            if cancel_event is None:
+                time.sleep(wait)
+            elif cancel_event.wait(wait):
+                raise TransientSearchError(f"{self.name} rate limit wait cancelled")
+
+    def pause(self, seconds):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens = 0.0
+            self.blocked_until = max(self.blocked_until, now + seconds)
+
+    def update_from_response(self, response):
+        """Adjust the refill rate from a provider response."""
+        headers = response.headers
+        if response.status_code == 429:
+            retry_after = parse_retry_after(headers.get("Retry-After"))
+            with self.lock:
+                self.rate = max(self.MIN_RATE, self.rate / 2)
+                wait = retry_after if retry_after is not None else 1 / self.rate
+            debug(f"🐢 {self.name} rate limited (429), pausing {wait:.1f}s at {self.rate:.2f} req/s")
+            self.pause(wait)
+            return
+
+        try:
+            remaining = int(headers["X-Ratelimit-Remaining"])
+            limit = int(headers.get("X-Ratelimit-Limit", 0))
+        except (KeyError, ValueError):
+            remaining = None
+            limit = 0
+
+        if remaining is None:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate * 1.25)
+            return
+
+        reset_in = self.QUOTA_WINDOW_SECONDS
+        reset = headers.get("X-Ratelimit-Reset")
+        if reset:
+            try:
+                reset_in = max(1.0, float(reset) - time.time())
+            except ValueError:
+                pass
+
+        if reset_in > self.QUOTA_WINDOW_SECONDS:
+            # Spreading a monthly quota over the month would crawl at MIN_RATE
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate * 1.25)
+            return
+
+        if remaining <= 0:
+            debug(f"🐢 {self.name} quota exhausted, pausing {reset_in:.0f}s until reset")
+            self.pause(reset_in)
+            return
+
+        with self.lock:
+            if remaining > max(self.capacity, limit * self.LOW_QUOTA_FRACTION):
+                self.rate = min(self.max_rate, self.rate * 1.25)
+            else:
+                # Running low: spread what is left over the rest of the window
+                self.rate = min(self.max_rate, max(self.MIN_RATE, remaining / reset_in))
+
+RATE_LIMITERS = {
+    source: TokenBucket(source, limits.get("rate", 1.0), limits.get("burst", 1))
+    for source, limits in RATE_LIMITS.items()
+}
+
+class TransientSearchError(Exception):
+    """A provider request failed in a way that may succeed later (timeout, 5xx, 429, open circuit)."""
+
+class ProviderError(Exception):
+    """A provider answered a search with an error: a missing or rejected key, another 4xx, an unreadable body.
+
+    Unlike an empty result it is never cached or journaled as "no result", so
+    the notes are searched again once the cause is fixed.
+    """
+
+class CircuitBreaker:
+    """Per-provider circuit breaker.
+
+    After failure_threshold consecutive transient failures the circuit opens and
+    requests fail fast. Once reset_timeout has passed a single probe request is
+    let through: success closes the circuit, failure reopens it with a doubled
+    timeout (capped at max_reset_timeout).
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout, max_reset_timeout=600):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.base_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                debug(f"🔌 {self.name} circuit half-open, sending probe request")
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != "closed":
+                debug(f"✅ {self.name} circuit closed, provider recovered")
+            self.state = "closed"
+            self.failures = 0
+            self.reset_timeout = self.base_reset_timeout
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "half_open":
+                self.reset_timeout = min(self.max_reset_timeout, self.reset_timeout * 2)
+            elif self.failures < self.failure_threshold:
+                return
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            debug(f"🚫 {self.name} circuit open for {self.reset_timeout:.0f}s after {self.failures} failures")
+
+    def cancel_probe(self):
+        """Give back a probe that allow() granted but that was never sent, so the next request can probe."""
+        with self.lock:
+            if self.state == "half_open":
+                self.state = "open"
+
+CIRCUIT_BREAKERS = {
+    source: CircuitBreaker(source, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_SECONDS)
+    for source in PROVIDER_CONCURRENCY
+}
+
+class QuotaLedger:
+    """Persistent count of the API calls left in each provider's quota windows, shared across runs.
+
+    There is one row per (source, key, window), where key is a short hash of
+    the provider's API key. Switching keys starts a fresh count, and the key
+    itself is never stored. Every request sent takes one call off each of
+    the source's windows. Afterwards the X-Ratelimit-* headers of Pexels
+    (monthly quota) and Unsplash (hourly quota) replace the local count with
+    the provider's own. A window is refilled once its reset time has
+    passed: an hour after it was opened, at the start of the next UTC month,
+    or when the provider's X-Ratelimit-Reset says so.
+    """
+
+    # Quota window described by each provider's X-Ratelimit-* headers
+    HEADER_WINDOWS = {"pexels": "month", "unsplash": "hour"}
+
+    def __init__(self, path, quotas, max_wait):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.max_wait = max_wait
+        self.limits = {
+            source: {window: int(limit) for window, limit in windows.items() if limit}
+            for source, windows in quotas.items()
+        }
+        self.keys = {
+            source: hashlib.sha1((config.get(SOURCE_KEYS.get(source, "")) or "").encode("utf-8")).hexdigest()[:12]
+            for source in self.limits
+        }
+        # (source, window) -> [calls left, reset time]
+        self.windows = {}
+        with self.lock, self.conn:
+            self.conn.execute(
+                """CREATE TABLE IF NOT EXISTS quota (
+                    source TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    window TEXT NOT NULL,
+                    remaining INTEGER NOT NULL,
+                    reset_at REAL NOT NULL,
+                    PRIMARY KEY (source, key, window)
+                )"""
+            )
+            for source, key in self.keys.items():
+                for window, remaining, reset_at in self.conn.execute(
+                    "SELECT window, remaining, reset_at FROM quota WHERE source = ? AND key = ?", (source, key)
+                ):
+                    if window in self.limits[source]:
+                        # The configured limit may have been lowered since
+                        self.windows[(source, window)] = [min(remaining, self.limits[source][window]), reset_at]
+
+    @staticmethod
+    def _next_reset(window, now):
+        if window == "hour":
+            return now + 3600
+        today = datetime.fromtimestamp(now, timezone.utc)
+        year, month = (today.year + 1, 1) if today.month == 12 else (today.year, today.month + 1)
+        return datetime(year, month, 1, tzinfo=timezone.utc).timestamp()
+
+    def _window(self, source, window, now):
+        """Return the [calls left, reset time] of a window, refilled if it has reset. Call with the lock held."""
+        state = self.windows.get((source, window))
+        if state is None or now >= state[1]:
+            state = self.windows[(source, window)] = [self.limits[source][window], self._next_reset(window, now)]
+        return state
+
+    def _save(self, source):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO quota VALUES (?, ?, ?, ?, ?)",
+                [
+                    (source, self.keys[source], window, *self.windows[(source, window)])
+                    for window in self.limits[source] if (source, window) in self.windows
+                ],
+            )
+
+    def status(self, source):
+        """Return {window: (limit, calls left, seconds until reset)} for the source's tracked windows."""
+        now = time.time()
+        status = {}
+        with self.lock:
+            for window, limit in self.limits.get(source, {}).items():
+                remaining, reset_at = self._window(source, window, now)
+                status[window] = (limit, remaining, reset_at - now)
+        return status
+
+    def take(self, source):
+        """Count one request that is about to be sent to source.
+
+        Returns 0 when it may be sent now, the seconds until a used-up window
+        resets (nothing is counted; call again after waiting), or None when
+        that is longer than max_wait.
+        """
+        now = time.time()
+        with self.lock:
+            states = [self._window(source, window, now) for window in self.limits.get(source, {})]
+            wait = max([reset_at - now for remaining, reset_at in states if remaining <= 0], default=0)
+            if wait > self.max_wait:
+                return None
+            if wait:
+                return wait
+            for state in states:
+                state[0] -= 1
+            if states:
+                self._save(source)
+            return 0
+
+    def update_from_response(self, source, response):
+        """Replace the local count with the provider's X-Ratelimit-* headers, when it sends them."""
+        window = self.HEADER_WINDOWS.get(source)
+        if window not in self.limits.get(source, {}):
+            return
+        headers = response.headers
+        try:
+            remaining = int(headers["X-Ratelimit-Remaining"])
+        except (KeyError, ValueError):
+            return
+        with self.lock:
+            state = self._window(source, window, time.time())
+            state[0] = remaining
+            try:
+                state[1] = float(headers["X-Ratelimit-Reset"])
+            except (KeyError, ValueError):
+                pass
+            try:
+                self.limits[source][window] = int(headers["X-Ratelimit-Limit"])
+            except (KeyError, ValueError):
+                pass
+            self._save(source)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+QUOTA_LEDGER = None
+
+def open_quota_ledger():
+    try:
+        return QuotaLedger(QUOTA_PATH, QUOTAS, QUOTA_MAX_WAIT_SECONDS)
+    except Exception as e:
+        warning(f"⚠️ Could not open quota ledger, continuing without quota tracking: {e}")
+        return None
+
+def provider_get(source, url, **kwargs):
+    """Send a rate-limited GET request to an image provider, retrying transient errors.
+
+    Request errors (timeouts, dropped connections, broken bodies, redirect
+    loops), HTTP 429 and 5xx responses are retried with jittered exponential
+    backoff, each counting as a circuit breaker failure. Every request sent is counted in QUOTA_LEDGER,
+    waiting for a used-up quota window to reset if needed. Raises
+    TransientSearchError when every attempt failed, the provider's circuit is
+    open, its quota is used up or the run was cancelled while waiting for its
+    quota or rate limit; other responses are returned as-is.
+    """
+    limiter = RATE_LIMITERS.get(source)
+    breaker = CIRCUIT_BREAKERS.get(source)
+    failure = None
+    for attempt in range(RETRY_ATTEMPTS):
+        if breaker and not breaker.allow():
+            raise TransientSearchError(f"{source} circuit open")
+        if QUOTA_LEDGER:
+            wait = QUOTA_LEDGER.take(source)
+            while wait:
+                debug(f"⏳ {source} quota used up, waiting {wait:.0f}s for it to reset")
+                with PROFILER.timer(f"wait:quota:{source}"):
+                    cancelled = CANCEL_EVENT.wait(wait)
+                if cancelled:
+                    if breaker:
+                        breaker.cancel_probe()
+                    raise TransientSearchError(f"{source} quota wait cancelled")
+                wait = QUOTA_LEDGER.take(source)
+            if wait is None:
+                if breaker:
+                    breaker.cancel_probe()
+                raise TransientSearchError(f"{source} quota used up")
+        if limiter:
+            try:
+                with PROFILER.timer(f"wait:rate_limit:{source}"):
+                    limiter.acquire(CANCEL_EVENT)
+            except TransientSearchError:
+                if breaker:
+                    breaker.cancel_probe()
+                raise
+        try:
+            with PROFILER.timer(f"http:{source}"):
+                response = get_session(source).get(url, timeout=REQUEST_TIMEOUT, **kwargs)
+        except requests.exceptions.RequestException as e:
+            failure = e
+        except Exception:
+            # Never leave a half-open circuit waiting for a probe result that will not come
+            if breaker:
+                breaker.record_failure()
+            raise
+        else:
+            if limiter:
+                limiter.update_from_response(response)
+            if QUOTA_LEDGER:
+                QUOTA_LEDGER.update_from_response(source, response)
+            if response.status_code != 429 and response.status_code < 500:
+                if breaker:
+                    breaker.record_success()
+                return response
+            failure = f"HTTP {response.status_code}"
+
+        if breaker:
+            breaker.record_failure()
+        if attempt + 1 < RETRY_ATTEMPTS:
+            delay = random.uniform(0, min(RETRY_MAX_BACKOFF_SECONDS, RETRY_BACKOFF_SECONDS * 2 ** attempt))
+            debug(f"🔁 {source} attempt {attempt + 1}/{RETRY_ATTEMPTS} failed ({failure}), retrying in {delay:.1f}s")
+            PROFILER.record(f"wait:backoff:{source}", delay)
+            time.sleep(delay)
+    raise TransientSearchError(f"{source} failed after {RETRY_ATTEMPTS} attempts: {failure}")
+
+def search_pexels(query, count=CANDIDATES_PER_QUERY, offset=0):
     PEXELS_API_KEY = config.get("PEXELS_API_KEY")
     if not PEXELS_API_KEY:
-        debug("⚠️ Missing Pexels API key in config.json.")
-        return None, None, None
+        warning("⚠️ Missing Pexels API key in config.json.")
+        raise ProviderError("Missing Pexels API key")
 
-    headers = {"Authorization": PEXELS_API_KEY}
-    params = {"query": query, "per_page": 1}
+    params = {"query": query, "per_page": count, "page": offset // count + 1}
 
     try:
-        debug(f"📡 Calling Pexels API for: {query}")
-        res = requests.get(
-            "https://api.pexels.com/v1/search",
-            headers=headers,
+        note_debug("📡 Calling Pexels API for: %s", query)
+        res = provider_get(
+            "pexels",
+            PEXELS_SEARCH_URL,
             params=params,
-            timeout=REQUEST_TIMEOUT,
         )
-        debug(f"📡 Pexels response status: {res.status_code}")
-        
-        if res.status_code == 200:
-            data = res.json()
-            if data["photos"]:
-                photo = data["photos"][0]
-                image_url = photo["src"]["medium"]
-                photographer = photo["photographer"]
-                photographer_url = photo["url"]
-                debug(f"✅ Pexels found image by {photographer}")
-                return image_url, photographer, photographer_url
-        debug(f"⚠️ No results from Pexels for: {query}")
-    except requests.exceptions.Timeout:
-        debug(f"❌ Pexels timeout for: {query}")
+        note_debug("📡 Pexels response status: %s", res.status_code)
+        if res.status_code != 200:
+            raise ProviderError(f"Pexels error {res.status_code}: {res.text[:200]}")
+
+        data = res.json()
+        candidates = [
+            (photo["src"]["medium"], photo["photographer"], photo["url"])
+            for photo in data["photos"]
+        ]
+    except TransientSearchError as e:
+        error(f"❌ Pexels unavailable for: {query} ({e})")
+        raise
+    except ProviderError as e:
+        error(f"❌ {e}")
+        raise
     except Exception as e:
-        debug(f"❌ Pexels error: {e}")
-    return None, None, None
+        error(f"❌ Pexels error: {e}")
+        raise ProviderError(f"Pexels error: {e}") from e
+    if candidates:
+        note_debug("✅ Pexels found %s images, first by %s", len(candidates), candidates[0][1])
+    else:
+        note_debug("⚠️ No results from Pexels for: %s", query)
+    return candidates
 
-def search_unsplash(query):
+def search_unsplash(query, count=CANDIDATES_PER_QUERY, offset=0):
     UNSPLASH_ACCESS_KEY = config.get("UNSPLASH_ACCESS_KEY")
     if not UNSPLASH_ACCESS_KEY:
-        debug("⚠️ Missing Unsplash API key in config.json.")
-        return None, None, None
+        warning("⚠️ Missing Unsplash API key in config.json.")
+        raise ProviderError("Missing Unsplash API key")
 
-    headers = {
-        "Accept-Version": "v1",
-        "Authorization": f"Client-ID {UNSPLASH_ACCESS_KEY}"
-    }
     params = {
         "query": query,
-        "per_page": 1
+        "per_page": count,
+        "page": offset // count + 1,
     }
 
     try:
-        debug(f"📡 Calling Unsplash API for: {query}")
-        res = requests.get(
-            "https://api.unsplash.com/search/photos",
-            headers=headers,
+        note_debug("📡 Calling Unsplash API for: %s", query)
+        res = provider_get(
+            "unsplash",
+            UNSPLASH_SEARCH_URL,
             params=params,
-            timeout=REQUEST_TIMEOUT,
         )
-        debug(f"📡 Unsplash response status: {res.status_code}")
-        
-        if res.status_code == 200:
-            data = res.json()
-            results = data.get("results", [])
-            if results:
-                photo = results[0]
-                image_url = photo["urls"]["regular"]
-                photographer = photo["user"]["name"]
-                photographer_url = photo["user"]["links"]["html"]
-                debug(f"✅ Unsplash found image by {photographer}")
-                return image_url, photographer, photographer_url
-            else:
-                debug(f"⚠️ No results from Unsplash for: {query}")
-        else:
-            debug(f"❌ Unsplash error {res.status_code}: {res.text}")
-    except requests.exceptions.Timeout:
-        debug(f"❌ Unsplash timeout for: {query}")
+        note_debug("📡 Unsplash response status: %s", res.status_code)
+        if res.status_code != 200:
+            raise ProviderError(f"Unsplash error {res.status_code}: {res.text[:200]}")
+
+        data = res.json()
+        candidates = [
+            (photo["urls"]["regular"], photo["user"]["name"], photo["user"]["links"]["html"])
+            for photo in data.get("results", [])
+        ]
+    except TransientSearchError as e:
+        error(f"❌ Unsplash unavailable for: {query} ({e})")
+        raise
+    except ProviderError as e:
+        error(f"❌ {e}")
+        raise
     except Exception as e:
-        debug(f"❌ Unsplash error: {e}")
-    return None, None, None
+        error(f"❌ Unsplash error: {e}")
+        raise ProviderError(f"Unsplash error: {e}") from e
+    if candidates:
+        note_debug("✅ Unsplash found %s images, first by %s", len(candidates), candidates[0][1])
+    else:
+        note_debug("⚠️ No results from Unsplash for: %s", query)
+    return candidates
+
+# SerpAPI returns this many Google Images results per page (selected with "ijn")
+SERPAPI_PAGE_SIZE = 100
 
-def search_serpapi(query):
+def search_serpapi(query, count=CANDIDATES_PER_QUERY, offset=0):
     SERPAPI_KEY = config.get("SERPAPI_KEY")
     if not SERPAPI_KEY:
-        debug("⚠️ Missing SerpAPI key in config.json.")
-        return None
+        warning("⚠️ Missing SerpAPI key in config.json.")
+        raise ProviderError("Missing SerpAPI key")
 
     params = {
         "q": query,
         "api_key": SERPAPI_KEY,
-        "engine": "google_images"
+        "engine": "google_images",
+        "ijn": offset // SERPAPI_PAGE_SIZE,
     }
 
     try:
-        debug(f"📡 Calling SerpAPI for: {query}")
-        res = requests.get("https://serpapi.com/search", params=params, timeout=REQUEST_TIMEOUT)
-        debug(f"📡 SerpAPI response status: {res.status_code}")
-        
-        if res.status_code == 200:
-            data = res.json()
-            images = data.get("images_results", [])
-            if images:
-                image = images[0]
-                image_url = image.get("original") or image.get("source") or image.get("thumbnail")
-                debug(f"✅ SerpAPI found image: {image_url}")
-                return image_url
-            else:
-                debug("⚠️ No images found in SerpAPI.")
-        else:
-            debug(f"❌ SerpAPI error {res.status_code}: {res.text}")
-    except requests.exceptions.Timeout:
-        debug(f"❌ SerpAPI timeout for: {query}")
+        note_debug("📡 Calling SerpAPI for: %s", query)
+        res = provider_get("serpapi", SERPAPI_SEARCH_URL, params=params)
+        note_debug("📡 SerpAPI response status: %s", res.status_code)
+        if res.status_code != 200:
+            raise ProviderError(f"SerpAPI error {res.status_code}: {res.text[:200]}")
+
+        data = res.json()
+        if data.get("error") and "images_results" not in data:
+            # SerpAPI reports "Google hasn't returned any results" as an error too
+            if "any results" not in data["error"]:
+                raise ProviderError(f"SerpAPI error: {data['error']}")
+        start = offset % SERPAPI_PAGE_SIZE
+        images = data.get("images_results", [])[start:start + count]
+        candidates = [
+            (image.get("original") or image.get("source") or image.get("thumbnail"), None, None)
+            for image in images
+        ]
+        candidates = [candidate for candidate in candidates if candidate[0]]
+    except TransientSearchError as e:
+        error(f"❌ SerpAPI unavailable for: {query} ({e})")
+        raise
+    except ProviderError as e:
+        error(f"❌ {e}")
+        raise
     except Exception as e:
-        debug(f"❌ SerpAPI request failed: {e}")
-    return None
+        error(f"❌ SerpAPI request failed: {e}")
+        raise ProviderError(f"SerpAPI request failed: {e}") from e
+    if candidates:
+        note_debug("✅ SerpAPI found %s images, first: %s", len(candidates), candidates[0][0])
+    else:
+        note_debug("⚠️ No images found in SerpAPI for: %s", query)
+    return candidates
 
 def update_note_picture(note_id, image_url, credit_text=None, credit_link=None):
-    debug(f"📝 Updating note {note_id} with image: {image_url}")
+    note_debug("📝 Updating note %s with image: %s", note_id, image_url)
     
     # Make the image clickable if credit_link exists
     if credit_link:
         img_tag = f'<a href="{credit_link}" target="_blank"><img src="{image_url}" style="max-width: 100%;"></a>'
-        debug(f"📷 Image with credit link to: {credit_link}")
+        note_debug("📷 Image with credit link to: %s", credit_link)
     else:
         img_tag = f'<img src="{image_url}" style="max-width: 100%;">'
-        debug(f"📷 Image without credit link")
+        note_debug("📷 Image without credit link")
 
     # Full HTML for the field
     full_html = img_tag
 
-    # Send the data to AnkiConnect
+    if NOTE_WRITER:
+        NOTE_WRITER.add(note_id, {PICTURE_FIELD: full_html})
+    else:
+        send_note_update(note_id, {PICTURE_FIELD: full_html})
+
+def send_note_update(note_id, fields):
+    """Send a single updateNoteFields request to AnkiConnect."""
     payload = {
         "action": "updateNoteFields",
         "version": 6,
         "params": {
             "note": {
                 "id": note_id,
-                "fields": {
-                    PICTURE_FIELD: full_html
-                }
+                "fields": fields
             }
         }
     }
     
     try:
-        response = requests.post(ANKI_CONNECT_URL, json=payload, timeout=REQUEST_TIMEOUT)
-        debug(f"📡 AnkiConnect update response: {response.status_code}")
+        if ANKI_BACKEND:
+            problem = backend_call("update_notes", [(note_id, fields)])[0]
+            if not problem:
+                note_debug("✅ Successfully updated note %s", note_id)
+                return True
+            error(f"❌ Failed to update note {note_id}: {problem}")
+            return False
+        response = ankiconnect_post(payload)
+        note_debug("📡 AnkiConnect update response: %s", response.status_code)
         if response.status_code == 200:
-            debug(f"✅ Successfully updated note {note_id}")
-        else:
-            debug(f"❌ Failed to update note {note_id}: {response.text}")
+            # AnkiConnect reports failures such as a deleted note as a 200 with an error
+            problem = response.json().get("error")
+            if not problem:
+                note_debug("✅ Successfully updated note %s", note_id)
+                return True
+            error(f"❌ Failed to update note {note_id}: {problem}")
+            return False
+        error(f"❌ Failed to update note {note_id}: {response.text}")
     except requests.exceptions.Timeout:
-        debug(f"❌ Timeout updating note {note_id} via AnkiConnect")
+        error(f"❌ Timeout updating note {note_id} via AnkiConnect")
     except requests.exceptions.ConnectionError as e:
-        debug(f"❌ Connection error updating note {note_id}: {e}")
+        error(f"❌ Connection error updating note {note_id}: {e}")
+    except Exception as e:
+        error(f"❌ Error updating note {note_id}: {e}")
+    return False
+
+class NoteUpdateBatcher:
+    """Write-behind buffer that sends note updates to AnkiConnect as `multi` requests.
+
+    Updates are flushed when batch_size of them are pending or when the oldest
+    pending update has waited max_delay seconds. Batches are taken and written
+    under send_lock, so updates reach the collection in the order they were
+    added. Every sub-result of a batch is checked on its own, so one rejected
+    note does not fail the others.
+    """
+
+    def __init__(self, batch_size, max_delay):
+        self.batch_size = max(1, batch_size)
+        self.max_delay = max_delay
+        self.pending = []
+        self.oldest = None
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.timer = threading.Thread(target=self._flush_periodically, name="note-writer", daemon=True)
+        self.timer.start()
+
+    def add(self, note_id, fields):
+        with self.lock:
+            if not self.pending:
+                self.oldest = time.monotonic()
+            self.pending.append((note_id, fields))
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def _take(self):
+        batch, self.pending, self.oldest = self.pending, [], None
+        return batch
+
+    def _flush_periodically(self):
+        while not self.stopped.wait(min(self.max_delay, 0.5)):
+            with self.lock:
+                due = self.oldest is not None and time.monotonic() - self.oldest >= self.max_delay
+            if due:
+                self.flush()
+
+    def flush(self):
+        """Write every pending update, returning once they and all earlier batches are written."""
+        with self.send_lock:
+            with self.lock:
+                batch = self._take()
+            if batch:
+                self._send(batch)
+
+    def close(self):
+        self.stopped.set()
+        self.timer.join()
+        self.flush()
+
+    def _write(self, batch):
+        """Write a batch, returning one error (or None) per update."""
+        if ANKI_BACKEND:
+            return backend_call("update_notes", batch)
+
+        actions = [
+            {
+                "action": "updateNoteFields",
+                "version": 6,
+                "params": {"note": {"id": note_id, "fields": fields}},
+            }
+            for note_id, fields in batch
+        ]
+        payload = {"action": "multi", "version": 6, "params": {"actions": actions}}
+        response = ankiconnect_post(payload)
+        body = response.json()
+        results = body.get("result")
+        if body.get("error") or not isinstance(results, list) or len(results) != len(batch):
+            raise ValueError(body.get("error") or f"unexpected multi response: {response.text[:200]}")
+        return [result.get("error") if isinstance(result, dict) else None for result in results]
+
+    def _send(self, batch):
+        """Write a batch; the caller holds send_lock."""
+        self.batches += 1
+        debug(f"📦 Writing batch of {len(batch)} note updates")
+        try:
+            errors = self._write(batch)
+        except Exception as e:
+            error(f"❌ Batch update failed ({e}), retrying {len(batch)} notes one by one")
+            for note_id, fields in batch:
+                if send_note_update(note_id, fields):
+                    self.written += 1
+                else:
+                    self.failed += 1
+            return
+
+        for (note_id, _), problem in zip(batch, errors):
+            if problem:
+                self.failed += 1
+                error(f"❌ Failed to update note {note_id}: {problem}")
+            else:
+                self.written += 1
+        debug(f"✅ Batch written ({self.written} updated, {self.failed} failed so far)")
+
+NOTE_WRITER = None
+
+def media_extension(image_url, content_type=None):
+    """Pick a file extension from the response Content-Type, falling back to the URL path."""
+    extension = mimetypes.guess_extension((content_type or "").split(";")[0].strip()) or ""
+    if not extension:
+        extension = os.path.splitext(urlparse(image_url).path)[1].lower()
+    if extension in ("", ".jpe", ".jpeg") or len(extension) > 5:
+        extension = ".jpg"
+    return extension
+
+# Media filenames and the media index use this many hex digits of the SHA-256
+MEDIA_DIGEST_LENGTH = 20
+MEDIA_FILENAME_PATTERN = re.compile(r"^mif_([0-9a-f]{%d})\.\w+$" % MEDIA_DIGEST_LENGTH)
+
+def media_filename(digest, extension):
+    """Content-addressed media filename, so identical images share one file."""
+    return f"mif_{digest[:MEDIA_DIGEST_LENGTH]}{extension}"
+
+def download_image(image_url):
+    """Stream an image to a temporary file in bounded chunks, hashing it on the way.
+
+    Returns (temp_path, sha256_digest, extension), or None if the download
+    failed, was not an image or exceeded MEDIA_MAX_BYTES.
+    """
+    os.makedirs(MEDIA_TMP_DIR, exist_ok=True)
+    temp_path = None
+    try:
+        with get_session("images", hosts=MEDIA_HOST_POOLS).get(image_url, stream=True, timeout=REQUEST_TIMEOUT) as response:
+            if response.status_code != 200:
+                error(f"❌ Image download failed with status {response.status_code}: {image_url}")
+                return None
+            content_type = response.headers.get("Content-Type", "")
+            if content_type and not content_type.startswith("image/"):
+                error(f"❌ Not an image ({content_type}): {image_url}")
+                return None
+
+            fd, temp_path = tempfile.mkstemp(prefix="download_", dir=MEDIA_TMP_DIR)
+            digest = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(MEDIA_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > MEDIA_MAX_BYTES:
+                        break
+                    digest.update(chunk)
+                    f.write(chunk)
+            if size > MEDIA_MAX_BYTES:
+                os.remove(temp_path)
+                error(f"❌ Image larger than {MEDIA_MAX_BYTES} bytes, skipped: {image_url}")
+                return None
+    except Exception as e:
+        error(f"❌ Error downloading image {image_url}: {e}")
+        if temp_path and os.path.exists(temp_path):
+            # A download broken off mid-stream must not leave its partial file behind
+            os.remove(temp_path)
+        return None
+
+    note_debug("⬇️ Downloaded %s bytes from %s", size, image_url)
+    return temp_path, digest.hexdigest(), media_extension(image_url, content_type)
+
+def encode_file_base64(path):
+    """Base64-encode a file chunk by chunk (chunks are a multiple of 3 bytes, so pieces concatenate)."""
+    parts = []
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(MEDIA_CHUNK_SIZE * 3), b""):
+            parts.append(base64.b64encode(chunk).decode("ascii"))
+    return "".join(parts)
+
+def store_media_file(path, filename):
+    """Store a local file in Anki's media folder via AnkiConnect, returning the stored filename.
+
+    With MEDIA_UPLOAD_MODE "path" AnkiConnect reads the file directly, which
+    works because it runs on the same machine; otherwise (or if that fails)
+    the file is sent inline as base64.
+    """
+    if ANKI_BACKEND:
+        try:
+            stored = backend_call("store_media", path, filename)
+            note_debug("💾 Stored media file %s (collection)", stored)
+            return stored
+        except Exception as e:
+            error(f"❌ Storing media file {filename} failed: {e}")
+            return None
+
+    modes = ["path", "data"] if MEDIA_UPLOAD_MODE == "path" else ["data"]
+    for mode in modes:
+        params = {"filename": filename, "deleteExisting": False}
+        if mode == "path":
+            params["path"] = os.path.abspath(path)
+        else:
+            params["data"] = encode_file_base64(path)
+        payload = {"action": "storeMediaFile", "version": 6, "params": params}
+        try:
+            response = ankiconnect_post(payload)
+            body = response.json()
+            if body.get("error"):
+                raise ValueError(body["error"])
+            stored = body.get("result") or filename
+            note_debug("💾 Stored media file %s (%s)", stored, mode)
+            return stored
+        except Exception as e:
+            error(f"❌ storeMediaFile ({mode}) failed for {filename}: {e}")
+    return None
+
+def get_media_dir_path():
+    payload = {"action": "getMediaDirPath", "version": 6}
+    try:
+        if ANKI_BACKEND:
+            return backend_call("media_dir")
+        response = ankiconnect_post(payload)
+        return response.json()["result"]
+    except Exception as e:
+        error(f"❌ Error getting media folder path: {e}")
+        return None
+
+class MediaIndex:
+    """Persistent content-hash index of images stored by this add-on.
+
+    Maps the SHA-256 digest of an image's downloaded bytes to its media
+    filename, and each source URL to the digest it downloaded to. A URL seen
+    before is reused without downloading it again; a new URL whose bytes match
+    a stored image reuses that file instead of storing a copy. Because stored
+    files are named after the digest of the downloaded bytes (even when they
+    were resized afterwards), the digest table can be rebuilt from the
+    add-on's filenames in the media folder. When media_dir is known, a
+    recorded file that is no longer there (deleted by Check Media, say) is
+    forgotten instead of reused.
+    """
+
+    def __init__(self, path, media_dir=None):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.media_dir = media_dir
+        self.reused = 0
+        self.stored = 0
+        with self.lock, self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS media (digest TEXT PRIMARY KEY, filename TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS media_urls (url TEXT PRIMARY KEY, digest TEXT NOT NULL)"
+            )
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM media").fetchone()[0]
+
+    def _existing(self, filename):
+        """Return filename if it is still in the media folder, otherwise forget it and return None."""
+        if filename and self.media_dir and not os.path.exists(os.path.join(self.media_dir, filename)):
+            note_debug("🗑️ %s is gone from the media folder, storing it again", filename)
+            self.forget(filename)
+            return None
+        return filename
+
+    def filename_for_url(self, url):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT media.filename FROM media_urls JOIN media USING (digest) WHERE media_urls.url = ?",
+                (url,),
+            ).fetchone()
+        return self._existing(row[0] if row else None)
+
+    def filename_for_digest(self, digest):
+        key = digest[:MEDIA_DIGEST_LENGTH]
+        with self.lock:
+            row = self.conn.execute("SELECT filename FROM media WHERE digest = ?", (key,)).fetchone()
+        return self._existing(row[0] if row else None)
+
+    def add(self, digest, filename, url=None):
+        digest = digest[:MEDIA_DIGEST_LENGTH]
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO media VALUES (?, ?)", (digest, filename))
+            if url:
+                self.conn.execute("INSERT OR REPLACE INTO media_urls VALUES (?, ?)", (url, digest))
+
+    def forget(self, filename):
+        """Drop a file that is gone from the media folder, returning the URLs it was downloaded from."""
+        with self.lock, self.conn:
+            urls = [row[0] for row in self.conn.execute(
+                "SELECT media_urls.url FROM media_urls JOIN media USING (digest) WHERE media.filename = ?",
+                (filename,),
+            )]
+            self.conn.execute(
+                "DELETE FROM media_urls WHERE digest IN (SELECT digest FROM media WHERE filename = ?)", (filename,)
+            )
+            self.conn.execute("DELETE FROM media WHERE filename = ?", (filename,))
+        return urls
+
+    def rebuild(self, media_dir):
+        """Replace the digest table with the add-on's mif_<digest> files found in the media folder."""
+        debug(f"🔁 Rebuilding media index from {media_dir}")
+        entries = []
+        for name in sorted(os.listdir(media_dir)):
+            match = MEDIA_FILENAME_PATTERN.match(name)
+            if match and os.path.isfile(os.path.join(media_dir, name)):
+                entries.append((match.group(1), name))
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM media")
+            self.conn.executemany("INSERT OR REPLACE INTO media VALUES (?, ?)", entries)
+            # URL rows pointing at files that no longer exist are useless
+            self.conn.execute("DELETE FROM media_urls WHERE digest NOT IN (SELECT digest FROM media)")
+        debug(f"✅ Media index rebuilt with {len(entries)} files")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+MEDIA_INDEX = None
+
+def transcode_image(path, max_size, quality, image_format):
+    """Downscale an image to fit max_size and re-encode it. Runs in a worker process.
+
+    The EXIF orientation is applied to the pixels, since the re-encoded file
+    carries no EXIF data. Returns (output_path, extension) for the new file, or
+    None if the original should be kept (animated image, or re-encoding did not
+    make it smaller).
+    """
+    with Image.open(path) as image:
+        if getattr(image, "is_animated", False):
+            return None
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_size, max_size))
+        if image_format == "jpeg":
+            if image.mode in ("RGBA", "LA", "P"):
+                # JPEG has no alpha channel: flatten transparency onto white
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, "white")
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            elif image.mode != "RGB":
+                image = image.convert("RGB")
+            extension = ".jpg"
+        else:
+            if image.mode not in ("RGB", "RGBA"):
+                image = image.convert("RGBA")
+            extension = ".webp"
+        output_path = path + extension
+        image.save(output_path, format=image_format.upper(), quality=quality, optimize=True)
+
+    if os.path.getsize(output_path) >= os.path.getsize(path):
+        os.remove(output_path)
+        return None
+    return output_path, extension
+
+TRANSCODE_POOL = None
+TRANSCODE_STATS = {"images": 0, "bytes_before": 0, "bytes_after": 0}
+_transcode_stats_lock = threading.Lock()
+
+def shrink_image(path, extension):
+    """Resize a downloaded image in the process pool, returning the (path, extension) to store."""
+    try:
+        result = TRANSCODE_POOL.submit(
+            transcode_image, path, IMAGE_MAX_SIZE, IMAGE_QUALITY, IMAGE_FORMAT
+        ).result()
+    except Exception as e:
+        warning(f"⚠️ Could not resize {path}, storing the original: {e}")
+        return path, extension
+    if not result:
+        return path, extension
+
+    output_path, output_extension = result
+    before = os.path.getsize(path)
+    after = os.path.getsize(output_path)
+    with _transcode_stats_lock:
+        TRANSCODE_STATS["images"] += 1
+        TRANSCODE_STATS["bytes_before"] += before
+        TRANSCODE_STATS["bytes_after"] += after
+    note_debug("🗜️ Resized image from %s to %s bytes", before, after)
+    return output_path, output_extension
+
+def open_transcode_pool():
+    if not RESIZE_IMAGES:
+        return None
+    if Image is None:
+        warning("⚠️ RESIZE_IMAGES is enabled but Pillow is not installed, images are stored unchanged")
+        return None
+    if IMAGE_FORMAT not in ("webp", "jpeg"):
+        warning(f"⚠️ Unsupported IMAGE_FORMAT '{IMAGE_FORMAT}', images are stored unchanged")
+        return None
+    debug(f"🗜️ Resizing images to {IMAGE_MAX_SIZE}px {IMAGE_FORMAT} (quality {IMAGE_QUALITY})")
+    if ANKI_BACKEND:
+        # Inside Anki, worker processes would start new copies of Anki itself;
+        # Pillow releases the GIL while resizing and encoding, so threads do well enough
+        return ThreadPoolExecutor(max_workers=TRANSCODE_PROCESSES or os.cpu_count(), thread_name_prefix="transcode")
+    return ProcessPoolExecutor(max_workers=TRANSCODE_PROCESSES)
+
+def store_remote_image(image_url):
+    """Download an image and store it in Anki's media folder, returning its media filename.
+
+    Images already in MEDIA_INDEX, by URL or by content, are reused instead of
+    being stored again.
+    """
+    if MEDIA_INDEX:
+        filename = MEDIA_INDEX.filename_for_url(image_url)
+        if filename:
+            MEDIA_INDEX.reused += 1
+            note_debug("♻️ Reusing %s for %s", filename, image_url)
+            return filename
+
+    with PROFILER.timer("media:download"):
+        downloaded = download_image(image_url)
+    if not downloaded:
+        return None
+    return store_image_file(*downloaded, image_url)
+
+def copy_local_image(path):
+    """Copy an image from the local library to a temporary file, hashing it on the way.
+
+    Returns (temp_path, sha256_digest, extension) like download_image(), or
+    None if the file could not be read or exceeded MEDIA_MAX_BYTES.
+    """
+    os.makedirs(MEDIA_TMP_DIR, exist_ok=True)
+    try:
+        if os.path.getsize(path) > MEDIA_MAX_BYTES:
+            error(f"❌ Image larger than {MEDIA_MAX_BYTES} bytes, skipped: {path}")
+            return None
+        fd, temp_path = tempfile.mkstemp(prefix="library_", dir=MEDIA_TMP_DIR)
+        digest = hashlib.sha256()
+        with open(path, "rb") as source, os.fdopen(fd, "wb") as f:
+            for chunk in iter(lambda: source.read(MEDIA_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                f.write(chunk)
+    except OSError as e:
+        error(f"❌ Error reading local image {path}: {e}")
+        return None
+    return temp_path, digest.hexdigest(), media_extension(path)
+
+def store_local_image(path):
+    """Store an image from the local library in Anki's media folder, returning its media filename.
+
+    Cards cannot link to a file elsewhere on the computer, so library images
+    are always stored, whether or not local media mode is on.
+    """
+    with PROFILER.timer("media:copy"):
+        copied = copy_local_image(path)
+    if not copied:
+        return None
+    return store_image_file(*copied, path)
+
+def store_image_file(temp_path, digest, extension, source_url):
+    """Store a downloaded or copied image (deleting the temporary file), returning its media filename.
+
+    An image whose bytes match one already in MEDIA_INDEX reuses that file.
+    """
+    upload_path = temp_path
+    try:
+        filename = MEDIA_INDEX.filename_for_digest(digest) if MEDIA_INDEX else None
+        if filename:
+            MEDIA_INDEX.reused += 1
+            note_debug("♻️ Same image already stored as %s, not storing %s again", filename, source_url)
+        else:
+            if TRANSCODE_POOL:
+                with PROFILER.timer("media:transcode"):
+                    upload_path, extension = shrink_image(temp_path, extension)
+            filename = store_media_file(upload_path, media_filename(digest, extension))
+            if not filename:
+                return None
+            if MEDIA_INDEX:
+                MEDIA_INDEX.stored += 1
+        if MEDIA_INDEX:
+            MEDIA_INDEX.add(digest, filename, source_url)
+        return filename
+    finally:
+        for path in {temp_path, upload_path}:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def open_media_index():
+    try:
+        index = MediaIndex(MEDIA_INDEX_PATH)
+    except Exception as e:
+        warning(f"⚠️ Could not open media index, images will not be deduplicated: {e}")
+        return None
+    media_dir = get_media_dir_path()
+    if media_dir and os.path.isdir(media_dir):
+        index.media_dir = media_dir
+    if args.rebuild_media_index or not index.count():
+        if index.media_dir:
+            index.rebuild(media_dir)
+        elif args.rebuild_media_index:
+            warning("⚠️ Media folder not accessible, media index not rebuilt")
+    return index
+
+# Compact per-note work item: the note id, its non-empty (field, query) pairs in SEARCH_FIELDS order
+# and, aligned with them, the shortened queries to try when a full query finds nothing
+NoteWorkItem = namedtuple("NoteWorkItem", ["note_id", "queries", "fallbacks"])
+
+class QueryMemo:
+    """Run-scoped memo so each unique query is searched once, even across threads.
+
+    The first caller for a query performs the search; concurrent callers for
+    the same query wait on its future instead of sending a duplicate request.
+    """
+
+    def __init__(self, search, key=normalize_query):
+        self.search = search
+        self.key = key
+        self.lock = threading.Lock()
+        self.futures = {}
+
+    def lookup(self, query):
+        key = self.key(query)
+        with self.lock:
+            future = self.futures.get(key)
+            owner = future is None
+            if owner:
+                future = self.futures[key] = Future()
+        if owner:
+            try:
+                future.set_result(self.search(query))
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def clear(self):
+        """Forget finished lookups, so failed ones are retried. Call only while no lookup is in flight."""
+        with self.lock:
+            self.futures.clear()
+
+    def __len__(self):
+        return len(self.futures)
+
+QUERY_MEMO = QueryMemo(search_image_url)
+# Same single-flight behaviour for storing images, keyed by the exact URL
+MEDIA_MEMO = QueryMemo(store_remote_image, key=str)
+LIBRARY_MEDIA_MEMO = QueryMemo(store_local_image, key=str)
+
+def iter_note_work_items(note_ids, page_size, since=None):
+    """Yield a compact NoteWorkItem per note, loading note info one page at a time.
+
+    Only the note id and the cleaned values of SEARCH_FIELDS are kept, so the
+    full note dicts (all fields and their HTML) can be released after each
+    page. Fields that clean to the same query as an earlier field are dropped.
+    With since (a Unix time), notes last modified before it are skipped.
+    """
+    for start in range(0, len(note_ids), page_size):
+        page = note_ids[start:start + page_size]
+        notes = get_notes_info(page)
+        if not notes:
+            warning(f"⚠️ Skipping page of {len(page)} notes starting at {start}: no note info returned")
+            continue
+        for note in notes:
+            if since is not None and note.get("mod", since) < since:
+                continue
+            fields = note["fields"]
+            normalizer = query_normalizer(note.get("modelName", ""))
+            queries = []
+            fallbacks = []
+            for field_name in SEARCH_FIELDS:
+                search_query = normalizer.clean(fields.get(field_name, {}).get("value", ""))
+                if search_query and all(search_query != query for _, query in queries):
+                    queries.append((field_name, search_query))
+                    fallbacks.append(normalizer.fallbacks(search_query))
+            yield NoteWorkItem(note["noteId"], tuple(queries), tuple(fallbacks))
+
+def plan_note_groups(work_items):
+    """Group notes that would send the same ordered queries, before any network call.
+
+    Returns a list of groups, each a dict with the ordered (field, query) pairs
+    to try, their fallback queries and the ids of every note sharing them.
+    """
+    groups = {}
+    for item in work_items:
+        key = (tuple(normalize_query(query) for _, query in item.queries), item.fallbacks)
+        group = groups.setdefault(key, {"queries": item.queries, "fallbacks": item.fallbacks, "note_ids": []})
+        group["note_ids"].append(item.note_id)
+    return list(groups.values())
+
+def fill_notes(note_ids, candidate):
+    """Put a candidate's image in the notes' picture field, storing it first in local media mode.
+
+    Returns False if the image could not be stored.
+    """
+    img_url, credit_name, credit_link, source = candidate
+    if source == "local":
+        img_url = LIBRARY_MEDIA_MEMO.lookup(img_url)
+        if not img_url:
+            return False
+    elif LOCAL_MEDIA:
+        # Keep the attribution pointing at the web: the photographer page or the original image
+        credit_link = credit_link or img_url
+        img_url = MEDIA_MEMO.lookup(img_url)
+        if not img_url:
+            return False
+    for note_id in note_ids:
+        update_note_picture(note_id, img_url, credit_name, credit_link)
+    return True
+
+def reroll_note(note_id):
+    """Give a note the next candidate of the pool its current image was picked from.
+
+    Returns "rerolled", "exhausted" when the provider has no further images,
+    "unknown" when the note's image was not picked from a cached pool, or
+    "transient" when more candidates could not be fetched or stored.
+    """
+    sample_note_logs(note_id)
+    pick = SEARCH_CACHE.get_pick(note_id)
+    if not pick:
+        note_debug("⏭️ Note %s has no recorded candidate pool", note_id)
+        return "unknown"
+    source, query, rank = pick
+    rank += 1
+    # Library searches are not cached: the index gives the current ranking in full
+    if source == "local":
+        pool = LOCAL_LIBRARY.search(query) if LOCAL_LIBRARY else []
+    else:
+        pool = SEARCH_CACHE.pool(source, query)
+    while rank >= len(pool):
+        # Pool used up: ask the provider for the next page, keeping only images not seen yet
+        try:
+            fetched = search_provider(source, query, offset=len(pool))
+        except (TransientSearchError, ProviderError) as e:
+            warning(f"⚠️ Could not fetch more images for note {note_id}: {e}")
+            return "transient"
+        seen = {candidate.image_url for candidate in pool}
+        fresh = [candidate for candidate in fetched if candidate.image_url not in seen]
+        if not fresh:
+            note_debug("⏭️ No more images for '%s' (%s) after %s candidates", query, source, len(pool))
+            return "exhausted"
+        SEARCH_CACHE.extend(source, query, fresh)
+        pool += fresh
+
+    if not fill_notes([note_id], pool[rank]):
+        return "transient"
+    SEARCH_CACHE.record_picks([note_id], source, query, rank)
+    note_debug("🎲 Note %s rerolled to candidate %s of '%s' (%s)", note_id, rank + 1, query, source)
+    return "rerolled"
+
+def reroll_notes(note_ids):
+    """Reroll each note's picture, returning a count of notes per reroll_note outcome."""
+    global SEARCH_CACHE, NOTE_WRITER, MEDIA_INDEX, TRANSCODE_POOL, QUOTA_LEDGER, LOCAL_LIBRARY
+    info(f"🎲 Rerolling {len(note_ids)} notes")
+    SEARCH_CACHE = SearchCache(CACHE_PATH, CACHE_TTL_SECONDS, CACHE_NEGATIVE_TTL_SECONDS, CACHE_MAX_ENTRIES)
+    QUOTA_LEDGER = open_quota_ledger()
+    LOCAL_LIBRARY = open_local_library()
+    NOTE_WRITER = NoteUpdateBatcher(WRITE_BATCH_SIZE, WRITE_BATCH_SECONDS)
+    if LOCAL_MEDIA or LOCAL_LIBRARY:
+        MEDIA_INDEX = open_media_index()
+        TRANSCODE_POOL = open_transcode_pool()
+
+    counts = {"rerolled": 0, "exhausted": 0, "unknown": 0, "transient": 0}
+    try:
+        # One note at a time: notes sharing a pool must not refill it concurrently
+        for note_id in note_ids:
+            counts[reroll_note(note_id)] += 1
+    finally:
+        NOTE_WRITER.close()
+        SEARCH_CACHE.close()
+        if QUOTA_LEDGER:
+            QUOTA_LEDGER.close()
+        if LOCAL_LIBRARY:
+            LOCAL_LIBRARY.close()
+        if MEDIA_INDEX:
+            MEDIA_INDEX.close()
+        if TRANSCODE_POOL:
+            TRANSCODE_POOL.shutdown()
+        close_sessions()
+    info(
+        f"🎲 Rerolled {counts['rerolled']} notes; {counts['exhausted']} had no more images, "
+        f"{counts['unknown']} had no candidate pool, {counts['transient']} failed"
+    )
+    return counts
+
+def process_group(group, position, total):
+    """Try each search field in order and fill every note in the group with the first image found.
+
+    Returns "filled", "no_result", or "transient" when a provider error stopped
+    the search before every field could be tried.
+    """
+    note_ids = group["note_ids"]
+    sample_note_logs(note_ids[0])
+    note_debug("📝 Processing group %s/%s - %s note(s): %s", position, total, len(note_ids), note_ids[:5])
+
+    if not group["queries"]:
+        note_debug("⏭️ Skipping notes %s: all search fields are empty", note_ids)
+        return "no_result"
+
+    for (field_name, search_query), fallbacks in zip(group["queries"], group["fallbacks"]):
+        # The full query first, then its shortened forms
+        for query in (search_query,) + fallbacks:
+            note_debug("🔍 Trying field '%s' with query '%s'", field_name, query)
+            try:
+                pool = QUERY_MEMO.lookup(query)
+            except (TransientSearchError, ProviderError) as e:
+                # Don't fall back to a shorter query or lower-priority field: it could win only because of the outage
+                warning(f"⚠️ Leaving notes {note_ids} for a later run: {e}")
+                return "transient"
+
+            # Skip images a link check found dead, in case the provider still returns them
+            rank, candidate = next(
+                ((rank, candidate) for rank, candidate in enumerate(pool) if candidate.image_url not in DEAD_IMAGE_URLS),
+                (None, None),
+            )
+            if candidate:
+                if not fill_notes(note_ids, candidate):
+                    warning(f"⚠️ Leaving notes {note_ids} for a later run: image could not be stored")
+                    return "transient"
+                if SEARCH_CACHE:
+                    SEARCH_CACHE.record_picks(note_ids, candidate.source, query, rank)
+                note_debug("✅ Image added to %s note(s) from field '%s'", len(note_ids), field_name)
+                return "filled"
+            note_debug("❌ No image found for '%s' in field '%s'", query, field_name)
+
+    note_debug("⏭️ Skipping notes %s: no image found for any search field.", note_ids)
+    return "no_result"
+
+class JobJournal:
+    """Append-only JSON-lines journal of note outcomes for one (deck, fields, source) job.
+
+    Each line records a note's latest outcome ("filled", "no_result" or
+    "transient") with the normalized queries that were tried. Resumed runs use
+    it to skip notes already known to have no image, as long as their queries
+    have not changed and the outcome is younger than the negative cache TTL.
+    The file is compacted to one line per note when superseded lines pile up.
+    A read_only journal (used by --plan) is loaded but never written.
+    """
+
+    COMPACT_MIN_LINES = 1000
+
+    def __init__(self, path, job, resume, read_only=False):
+        self.path = path
+        self.job = job
+        self.lock = threading.Lock()
+        self.outcomes = {}
+        self.lines = 0
+        self.skipped = 0
+        self.file = None
+        if resume and os.path.exists(path):
+            self._load()
+        if read_only:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.lines:
+            self.compact()
+        else:
+            self._rewrite()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def _load(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                self.lines += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A run killed mid-write can leave a truncated last line
+                    continue
+                if "note" in entry:
+                    self.outcomes[entry["note"]] = entry
+        debug(f"📒 Loaded journal with {len(self.outcomes)} note outcomes from {self.path}")
+
+    def _rewrite(self):
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"job": self.job}, ensure_ascii=False) + "\n")
+            for entry in self.outcomes.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(temp_path, self.path)
+        self.lines = len(self.outcomes) + 1
+
+    def compact(self):
+        """Rewrite the journal with only the latest outcome of each note."""
+        if self.lines > len(self.outcomes) + 1:
+            self._rewrite()
+            debug(f"📒 Compacted journal to {len(self.outcomes)} notes")
+
+    def known_empty(self, item):
+        entry = self.outcomes.get(item.note_id)
+        if not entry or entry["status"] != "no_result":
+            return False
+        if time.time() - entry["time"] > CACHE_NEGATIVE_TTL_SECONDS:
+            return False
+        return entry["queries"] == [normalize_query(query) for _, query in item.queries]
+
+    def record(self, note_ids, status, queries):
+        if self.file is None:
+            return
+        now = time.time()
+        normalized = [normalize_query(query) for _, query in queries]
+        with self.lock:
+            for note_id in note_ids:
+                entry = {"note": note_id, "status": status, "queries": normalized, "time": now}
+                self.outcomes[note_id] = entry
+                self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                self.lines += 1
+            self.file.flush()
+            if self.lines > max(self.COMPACT_MIN_LINES, 2 * len(self.outcomes)):
+                self.file.close()
+                self.compact()
+                self.file = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.compact()
+
+JOURNAL = None
+
+def job_key():
+    """Short stable id of the (deck, fields, source) job, used to name its journal and watch files."""
+    job = {"deck": DECK_NAME, "fields": SEARCH_FIELDS, "source": IMAGE_SOURCE}
+    return hashlib.sha1(json.dumps(job, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def open_journal(read_only=False):
+    job = {"deck": DECK_NAME, "fields": SEARCH_FIELDS, "source": IMAGE_SOURCE}
+    path = os.path.join(JOURNAL_DIR, f"{job_key()}.jsonl")
+    try:
+        return JobJournal(path, job, resume=args.resume, read_only=read_only)
+    except Exception as e:
+        warning(f"⚠️ Could not open job journal, continuing without it: {e}")
+        return None
+
+def skip_known_empty(work_items):
+    """Drop work items the journal already recorded as having no image for the same queries."""
+    for item in work_items:
+        if JOURNAL and args.resume and JOURNAL.known_empty(item):
+            JOURNAL.skipped += 1
+            continue
+        yield item
+
+def open_search_cache():
+    if args.no_cache:
+        debug("⏭️ Search cache disabled (--no-cache)")
+        return None
+    try:
+        cache = SearchCache(
+            CACHE_PATH,
+            CACHE_TTL_SECONDS,
+            CACHE_NEGATIVE_TTL_SECONDS,
+            CACHE_MAX_ENTRIES,
+            read=not args.refresh,
+        )
+        debug(f"💾 Search cache opened: {CACHE_PATH}" + (" (refresh)" if args.refresh else ""))
+        return cache
     except Exception as e:
-        debug(f"❌ Error updating note {note_id}: {e}")
+        warning(f"⚠️ Could not open search cache, continuing without it: {e}")
+        return None
+
+class ProgressReporter:
+    """Writes JSON-lines progress events to stdout for the add-on's progress dialog.
+
+    When running inside Anki, events are passed as dicts to sink instead.
+
+    A background thread emits a "progress" event every interval seconds, which
+    also serves as a heartbeat so the add-on can tell a slow run from a stalled
+    one. Phase changes, errors and the final summary are emitted as they happen.
+    """
+
+    def __init__(self, interval, sink=None):
+        self.interval = interval
+        self.sink = sink
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.started = time.monotonic()
+        self.total = 0
+        self.queued = 0
+        self.counts = {"done": 0, "filled": 0, "no_result": 0, "transient": 0, "errors": 0}
+        self.thread = None
+
+    def emit(self, event, **fields):
+        if self.sink:
+            self.sink(dict(event=event, **fields))
+            return
+        if sys.stdout is None:
+            return
+        line = json.dumps(dict(event=event, **fields))
+        with self.lock:
+            try:
+                sys.stdout.write(line + "\n")
+                sys.stdout.flush()
+            except (OSError, ValueError):
+                # The add-on closed the pipe; keep working and log as usual
+                pass
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.started
+        done = self.counts["done"]
+        rate = done / elapsed if elapsed > 0 else 0.0
+        latency = {}
+        for source in SOURCE_KEYS:
+            _, values = PROFILER.durations(f"search:{source}")
+            if values:
+                latency[source] = round(percentile(values, 50) * 1000)
+        return dict(
+            self.counts,
+            total=self.total,
+            queue=self.queued,
+            elapsed=round(elapsed, 1),
+            rate=round(rate, 2),
+            eta=round((self.total - done) / rate) if rate and self.total > done else None,
+            cache_hits=SEARCH_CACHE.hits if SEARCH_CACHE else 0,
+            cache_misses=SEARCH_CACHE.misses if SEARCH_CACHE else 0,
+            latency_ms=latency,
+        )
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.emit("progress", **self.snapshot())
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self._run, name="progress", daemon=True)
+        self.thread.start()
 
-def main():
-    debug("🔄 Starting Magic Image Fetcher main()")
+    def stop(self, **fields):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.emit("done", **self.snapshot(), **fields)
+
+PROGRESS = None
+
+def report(event, **fields):
+    """Emit a progress event if --progress is enabled."""
+    if PROGRESS:
+        PROGRESS.emit(event, **fields)
+
+def main(argv=None, backend=None, progress_sink=None, cancel_event=None, wake_event=None):
+    """Run the fetcher.
+
+    The add-on passes backend (see ANKI_BACKEND), progress_sink and
+    cancel_event when it runs the fetcher inside Anki; setting cancel_event
+    stops the run after the notes in flight, leaving the rest to be resumed.
+    In watch mode, setting wake_event makes the next poll happen right away.
+    """
+    global JOURNAL, PROGRESS, PROFILER
+    global ANKI_BACKEND, CANCEL_EVENT
+    info("🔄 Starting Magic Image Fetcher main()")
+    PROFILER = Profiler()
+    ANKI_BACKEND = backend
+    CANCEL_EVENT = cancel_event or threading.Event()
+    configure(parse_args(argv))
+    if args.progress or progress_sink:
+        PROGRESS = ProgressReporter(PROGRESS_INTERVAL_SECONDS, sink=progress_sink)
 
     if not config:
-        debug("❌ Missing config. Aborting.")
+        error("❌ Missing config. Aborting.")
+        report("error", message="Missing config.json. Please add your API keys.")
         return
 
     # Check AnkiConnect before starting
-    if not check_ankiconnect_available():
-        debug("❌ AnkiConnect is not available. Make sure Anki is running and AnkiConnect add-on is installed.")
+    report("phase", phase="Connecting to AnkiConnect")
+    with PROFILER.timer("phase:connect"):
+        available = check_ankiconnect_available()
+    if not available:
+        error("❌ AnkiConnect is not available. Make sure Anki is running and AnkiConnect add-on is installed.")
+        report("error", message="AnkiConnect is not available. Make sure the AnkiConnect add-on is installed.")
         return
 
-    note_ids = search_anki_for_empty_picture_notes()
-    debug(f"🟡 Found {len(note_ids)} notes with empty picture fields.")
+    if args.reroll:
+        return reroll_notes([int(note_id) for note_id in args.reroll.split(",") if note_id.strip()])
+
+    if args.watch:
+        return watch_deck(cancel_event, wake_event)
+
+    if args.check_links:
+        return check_links(cancel_event)
+
+    report("phase", phase="Searching for notes without pictures")
+    with PROFILER.timer("phase:find_notes"):
+        note_ids = search_anki_for_empty_picture_notes() or []
+    info(f"🟡 Found {len(note_ids)} notes with empty picture fields.")
 
     if not note_ids:
-        debug("⚠️ No matching notes to update.")
+        warning("⚠️ No matching notes to update.")
+        report("done", total=0, done=0, filled=0)
         return
 
-    notes = get_notes_info(note_ids)
-    debug(f"🟡 Retrieved {len(notes)} notes with full info.")
+    # A plan reads the journal to skip what a resumed run would skip, but must not rewrite it
+    JOURNAL = open_journal(read_only=args.plan)
+    report("phase", phase=f"Loading {len(note_ids)} notes")
+    with PROFILER.timer("phase:load_and_plan"):
+        groups = plan_note_groups(skip_known_empty(iter_note_work_items(note_ids, NOTES_PAGE_SIZE)))
+    planned_count = sum(len(group["note_ids"]) for group in groups)
+    if JOURNAL and JOURNAL.skipped:
+        info(f"📒 Resuming: skipped {JOURNAL.skipped} notes already known to have no image")
+    unique_queries = {normalize_query(query) for group in groups for _, query in group["queries"]}
+    info(
+        f"🧮 Planned {planned_count} notes into {len(groups)} groups "
+        f"with {len(unique_queries)} unique queries"
+    )
 
-    processed_count = 0
-    success_count = 0
+    if not open_run_resources():
+        return
+    groups, plan = plan_quota(groups)
+    if args.plan:
+        close_run_resources()
+        print(json.dumps(plan))
+        return plan
+    planned_count = sum(len(group["note_ids"]) for group in groups)
+    report("phase", phase=f"About {plan['calls']} {plan['source']} searches needed, at least {plan['eta'] // 60} min")
+    info(f"🧵 Processing {len(groups)} groups with {WORKERS} workers")
+    if PROGRESS:
+        PROGRESS.total = planned_count
+        PROGRESS.queued = len(groups)
+        PROGRESS.start()
+    with PROFILER.timer("phase:process"):
+        counts = process_groups(groups, cancel_event)
+
+    close_run_resources()
+    info(f"🎉 Processing complete! Updated {counts['filled']}/{counts['processed']} notes")
+    info(
+        f"📊 {counts['processed'] - counts['filled'] - counts['transient']} notes had no results, "
+        f"{counts['transient']} failed on provider errors and can be retried"
+    )
+    if counts["processed"]:
+        info(
+            f"🧮 Searched {len(QUERY_MEMO)} unique queries for {counts['processed']} notes "
+            f"({len(QUERY_MEMO) / counts['processed']:.2f} queries per note)"
+        )
 
-    for note in notes:
-        fields = note["fields"]
-        note_id = note["noteId"]
-        processed_count += 1
-        debug(f"📝 Processing note {processed_count}/{len(notes)} - ID: {note_id}")
+    profile = PROFILER.summary()
+    PROFILER.log_summary(profile)
+    if args.profile_json:
+        PROFILER.export_json(
+            args.profile_json,
+            profile,
+            deck=DECK_NAME,
+            source=IMAGE_SOURCE,
+            workers=WORKERS,
+            notes=counts["processed"],
+            filled=counts["filled"],
+            unique_queries=len(QUERY_MEMO),
+        )
+    if PROGRESS:
+        PROGRESS.stop()
 
-        image_found = False
+def plan_quota(groups):
+    """Estimate the API calls and time the groups need, and fit the run into the remaining quota.
 
-        for field_name in SEARCH_FIELDS:
-            search_query = fields.get(field_name, {}).get("value", "").strip()
-            if not search_query:
-                debug(f"⏭️ Field '{field_name}' is empty, skipping")
+    One call is counted per distinct uncached first query: groups that fall
+    back to shorter queries or later fields cost more, so this is a lower
+    bound. Queries the local library answers first cost nothing. If the
+    calls exceed what is left of the hourly quota, the source's
+    request rate is lowered so the run spreads over the hours instead of
+    stalling. If they exceed the monthly quota, the groups that would go past
+    it are left for a later run. Race mode only reports the estimate for its
+    first source.
+
+    Returns (groups to process now, plan dict).
+    """
+    source = RACE_SOURCES[0] if IMAGE_SOURCE == "race" else IMAGE_SOURCE
+    counted = set()
+    kept = []
+    deferred_notes = 0
+    quota = QUOTA_LEDGER.status(source) if QUOTA_LEDGER else {}
+    month_left = quota["month"][1] if "month" in quota and IMAGE_SOURCE != "race" else None
+    library_first = LOCAL_LIBRARY and LOCAL_LIBRARY_FIRST
+    for group in groups:
+        key = normalize_query(group["queries"][0][1]) if group["queries"] else None
+        needs_call = (
+            key is not None and source != "local" and key not in counted
+            and not (SEARCH_CACHE and SEARCH_CACHE.has(source, key))
+            and not (library_first and LOCAL_LIBRARY.search(key, 1))
+        )
+        if needs_call:
+            if month_left is not None and len(counted) >= month_left:
+                deferred_notes += len(group["note_ids"])
                 continue
+            counted.add(key)
+        kept.append(group)
+    calls = len(counted)
+
+    limiter = RATE_LIMITERS.get(source)
+    rate = limiter.max_rate if limiter else 1.0
+    if "hour" in quota and IMAGE_SOURCE != "race" and calls > quota["hour"][1]:
+        rate = min(rate, quota["hour"][0] / 3600)
+        if limiter:
+            limiter.max_rate = limiter.rate = rate
+        info(f"🐢 {calls} calls exceed the {quota['hour'][1]} left this hour on {source}, pacing at {rate * 3600:.0f}/hour")
+    plan = {
+        "source": source,
+        "calls": calls,
+        "eta": round(calls / rate),
+        "deferred": deferred_notes,
+        "quota": {window: {"limit": limit, "remaining": left} for window, (limit, left, _) in quota.items()},
+    }
+    info(
+        f"🗓️ Plan: about {calls} {source} calls for {sum(len(g['note_ids']) for g in kept)} notes, "
+        f"at least {plan['eta'] / 60:.1f} min; quota left {plan['quota'] or 'untracked'}"
+    )
+    if deferred_notes:
+        warning(f"⚠️ Monthly {source} quota would run out: leaving {deferred_notes} notes for after it resets")
+    return kept, plan
 
-            debug(f"🔍 Trying field '{field_name}' with query '{search_query}'")
-            img_url, credit_name, credit_link = search_image_url(search_query)
-            time.sleep(REQUEST_PAUSE_SECONDS)
+def open_run_resources():
+    """Open the race pool, search cache, local library, note writer and local media helpers of a fill run.
 
-            if img_url:
-                update_note_picture(note_id, img_url, credit_name, credit_link)
-                debug(f"✅ Image added to note {note_id} from field '{field_name}'")
-                image_found = True
-                success_count += 1
-                break
-            else:
-                debug(f"❌ No image found for '{search_query}' in field '{field_name}'")
-                time.sleep(REQUEST_PAUSE_SECONDS)
+    Returns False when race mode is selected without any configured source,
+    or the local source without a usable LOCAL_LIBRARY_DIR.
+    """
+    global SEARCH_CACHE, NOTE_WRITER, MEDIA_INDEX, TRANSCODE_POOL, RACE_SOURCES, HEDGE_POOL, QUOTA_LEDGER
+    global LOCAL_LIBRARY
+    LOCAL_LIBRARY = open_local_library()
+    if IMAGE_SOURCE == "local" and not LOCAL_LIBRARY:
+        error("❌ The local source needs LOCAL_LIBRARY_DIR set to a folder of images. Aborting.")
+        report("error", message="The local source needs LOCAL_LIBRARY_DIR set to a folder of images.")
+        return False
+    if IMAGE_SOURCE == "race":
+        RACE_SOURCES = available_sources()
+        if not RACE_SOURCES:
+            error("❌ Race mode needs at least one configured API key. Aborting.")
+            report("error", message="Race mode needs at least one configured API key.")
+            return False
+        HEDGE_POOL = ThreadPoolExecutor(max_workers=WORKERS * len(RACE_SOURCES), thread_name_prefix="hedge")
+        debug(f"🏁 Race mode: {RACE_SOURCES}, hedging after {HEDGE_DELAY_SECONDS}s")
+    SEARCH_CACHE = open_search_cache()
+    QUOTA_LEDGER = open_quota_ledger()
+    NOTE_WRITER = NoteUpdateBatcher(WRITE_BATCH_SIZE, WRITE_BATCH_SECONDS)
+
+    if LOCAL_MEDIA:
+        debug(f"💾 Local media mode: images are stored in Anki's media folder ({MEDIA_UPLOAD_MODE} upload)")
+    if LOCAL_MEDIA or LOCAL_LIBRARY:
+        # Library images are always stored in the media folder
+        MEDIA_INDEX = open_media_index()
+        TRANSCODE_POOL = open_transcode_pool()
+    return True
+
+def close_run_resources():
+    """Flush pending note updates, then log the totals of each open resource and close it."""
+    with PROFILER.timer("phase:flush_writes"):
+        NOTE_WRITER.close()
+    info(f"📦 Wrote {NOTE_WRITER.written} notes in {NOTE_WRITER.batches} batches ({NOTE_WRITER.failed} failed)")
+    if JOURNAL:
+        JOURNAL.close()
+    if HEDGE_POOL:
+        HEDGE_POOL.shutdown(wait=True)
+    RACE_STATS.log_summary()
+    if SEARCH_CACHE:
+        info(f"💾 Cache: {SEARCH_CACHE.hits} hits, {SEARCH_CACHE.misses} misses")
+        SEARCH_CACHE.close()
+    if QUOTA_LEDGER:
+        for source in available_sources():
+            quota = QUOTA_LEDGER.status(source)
+            if quota:
+                info(f"🗓️ {source} quota left: " + ", ".join(f"{left}/{limit} this {window}" for window, (limit, left, _) in quota.items()))
+        QUOTA_LEDGER.close()
+    if LOCAL_LIBRARY:
+        info(f"🗂️ Local library: {LOCAL_LIBRARY.hits} queries answered, {LOCAL_LIBRARY.misses} not found")
+        LOCAL_LIBRARY.close()
+    if MEDIA_INDEX:
+        info(f"♻️ Media: {MEDIA_INDEX.stored} images stored, {MEDIA_INDEX.reused} reused")
+        MEDIA_INDEX.close()
+    if TRANSCODE_POOL:
+        TRANSCODE_POOL.shutdown()
+        saved = TRANSCODE_STATS["bytes_before"] - TRANSCODE_STATS["bytes_after"]
+        info(
+            f"🗜️ Resized {TRANSCODE_STATS['images']} images, saved {saved / (1024 * 1024):.1f} MB "
+            f"({TRANSCODE_STATS['bytes_before']} → {TRANSCODE_STATS['bytes_after']} bytes)"
+        )
+    close_sessions()
 
-        if not image_found:
-            debug(f"⏭️ Skipping note {note_id}: no image found for any search field.")
+def process_groups(groups, cancel_event=None):
+    """Process planned groups on WORKERS threads and journal their outcomes.
 
-        time.sleep(REQUEST_PAUSE_SECONDS)
+    Setting cancel_event cancels the groups not started yet. Returns the number
+    of notes processed, filled and failed on provider errors, plus the ids of
+    the latter under "retry_ids".
+    """
+    counts = {"processed": 0, "filled": 0, "transient": 0, "retry_ids": []}
+    with ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="fetch") as executor:
+        futures = {
+            executor.submit(process_group, group, position, len(groups)): group
+            for position, group in enumerate(groups, start=1)
+        }
+        cancelled = False
+        for future in as_completed(futures):
+            if cancel_event and cancel_event.is_set() and not cancelled:
+                # Groups not started yet are left out of the journal, so the next run resumes them
+                info("🛑 Run cancelled, finishing the notes in flight")
+                cancelled = True
+                for pending in futures:
+                    pending.cancel()
+            if future.cancelled():
+                if PROGRESS:
+                    PROGRESS.queued -= 1
+                continue
+            note_ids = futures[future]["note_ids"]
+            counts["processed"] += len(note_ids)
+            status = "error"
+            try:
+                status = future.result()
+                if JOURNAL:
+                    JOURNAL.record(note_ids, status, futures[future]["queries"])
+                if status == "filled":
+                    counts["filled"] += len(note_ids)
+                elif status == "transient":
+                    counts["transient"] += len(note_ids)
+                    counts["retry_ids"].extend(note_ids)
+            except Exception as e:
+                error(f"❌ Unexpected error processing notes {note_ids}: {e}")
+            if PROGRESS:
+                PROGRESS.queued -= 1
+                PROGRESS.counts["done"] += len(note_ids)
+                PROGRESS.counts["errors" if status == "error" else status] += len(note_ids)
+    return counts
 
-    debug(f"🎉 Processing complete! Updated {success_count}/{processed_count} notes")
+# A whole picture field as update_note_picture writes it: the image, optionally wrapped in a credit link.
+# Fields that don't match were written or edited by the user and are never touched by the link check.
+ADDON_PICTURE_RE = re.compile(
+    r'(?:<a href="([^"]*)" target="_blank">)?<img src="([^"]*)" style="max-width: 100%;">(?(1)</a>)'
+)
+# Answers meaning an image is gone for good; 403 (often bot or hotlink protection), timeouts,
+# connection errors and 5xx only make it "unknown"
+DEAD_LINK_STATUSES = {404, 410}
+
+# Image URLs found dead by check_links(), never picked again in the same run
+DEAD_IMAGE_URLS = set()
+
+def check_link(url):
+    """Return "ok", "dead" or "unknown" for an image URL.
+
+    Sends a HEAD request, confirmed with a one-byte ranged GET when the
+    server refuses HEAD. An HTML page where an image was expected (a
+    provider's "not found" page behind a redirect) also counts as dead.
+    """
+    session = get_session("links", pool_size=LINK_CHECK_WORKERS, hosts=LINK_CHECK_WORKERS)
+    try:
+        with PROFILER.timer("links:head"):
+            response = session.head(url, allow_redirects=True, timeout=LINK_CHECK_TIMEOUT)
+        if response.status_code in (403, 405, 501):
+            with PROFILER.timer("links:get"):
+                response = session.get(
+                    url, headers={"Range": "bytes=0-0"}, stream=True, allow_redirects=True, timeout=LINK_CHECK_TIMEOUT
+                )
+                response.close()
+    except requests.exceptions.RequestException as e:
+        note_debug("🔗 Could not check %s: %s", url, e)
+        return "unknown"
+    if response.status_code in DEAD_LINK_STATUSES:
+        return "dead"
+    if response.status_code < 300:
+        return "dead" if response.headers.get("Content-Type", "").startswith("text/html") else "ok"
+    return "unknown"
+
+def read_note_pictures(note_ids):
+    """Return {note id: (image src, credit link or None)} for notes whose picture field the add-on wrote."""
+    pictures = {}
+    for start in range(0, len(note_ids), NOTES_PAGE_SIZE):
+        for note in get_notes_info(note_ids[start:start + NOTES_PAGE_SIZE]) or []:
+            value = note["fields"].get(PICTURE_FIELD, {}).get("value", "")
+            match = ADDON_PICTURE_RE.fullmatch(value.strip())
+            if match and match.group(2):
+                href, src = match.groups()
+                pictures[note["noteId"]] = (html.unescape(src), html.unescape(href) if href else None)
+    return pictures
+
+def check_links(cancel_event=None):
+    """Check the images already in the deck's picture fields and repair the notes whose image is gone.
+
+    Only picture fields the add-on wrote are looked at (see ADDON_PICTURE_RE).
+    Each distinct remote URL is checked once, LINK_CHECK_WORKERS at a time.
+    The add-on's mif_ media files are checked for existence; a missing one is
+    downloaded again from the URL recorded in MEDIA_INDEX when that still
+    works. Notes left with a dead image lose it: the URL is dropped from
+    the search cache, the picture field is cleared and the notes are
+    searched again like in a normal run, so any that find nothing are
+    picked up by later runs. Returns the scan's counts.
+    """
+    if not open_run_resources():
+        return
+    report("phase", phase="Searching for notes with pictures")
+    note_ids = search_anki_for_notes(f'deck:"{DECK_NAME}" {PICTURE_FIELD}:_*') or []
+    report("phase", phase=f"Reading the pictures of {len(note_ids)} notes")
+    with PROFILER.timer("phase:load"):
+        pictures = read_note_pictures(note_ids)
+    remote = {}
+    local = {}
+    for note_id, (src, _) in pictures.items():
+        if urlparse(src).scheme in ("http", "https"):
+            remote.setdefault(src, []).append(note_id)
+        elif MEDIA_FILENAME_PATTERN.match(unquote(src)):
+            # Only the add-on's own mif_ files: data: URIs and other media are not ours to repair
+            local.setdefault(src, []).append(note_id)
+    info(
+        f"🔗 {len(pictures)} notes have pictures from the add-on: "
+        f"{len(remote)} distinct links, {len(local)} media files"
+    )
+
+    status = {}
+    started = time.monotonic()
+    with PROFILER.timer("phase:check_links"), ThreadPoolExecutor(max_workers=LINK_CHECK_WORKERS, thread_name_prefix="links") as executor:
+        futures = {executor.submit(check_link, url): url for url in remote}
+        for done, future in enumerate(as_completed(futures), start=1):
+            if cancel_event and cancel_event.is_set():
+                for pending in futures:
+                    pending.cancel()
+            if future.cancelled():
+                continue
+            status[futures[future]] = future.result()
+            if done % 100 == 0:
+                report("phase", phase=f"Checked {done}/{len(remote)} links")
+    elapsed = max(time.monotonic() - started, 1e-6)
+    dead_urls = [url for url, result in status.items() if result == "dead"]
+    dead_links = len(dead_urls)
+    unknown = sum(1 for result in status.values() if result == "unknown")
+    info(
+        f"🔗 Checked {len(status)} links in {elapsed:.1f}s ({len(status) / elapsed:.0f} links/s): "
+        f"{dead_links} dead, {unknown} could not be checked"
+    )
+
+    media_dir = get_media_dir_path() if local else None
+    missing = [name for name in local if media_dir and not os.path.exists(os.path.join(media_dir, unquote(name)))]
+    dead_note_ids = [note_id for url in dead_urls for note_id in remote[url]]
+    redownloaded = 0
+    for name in missing:
+        source_urls = MEDIA_INDEX.forget(unquote(name)) if MEDIA_INDEX else []
+        filename = next(filter(None, (
+            store_local_image(url) if os.path.isfile(url) else store_remote_image(url) for url in source_urls
+        )), None)
+        if filename:
+            for note_id in local[name]:
+                update_note_picture(note_id, filename, credit_link=pictures[note_id][1])
+            redownloaded += len(local[name])
+        else:
+            # Its source is gone too: don't pick the same image when searching again
+            dead_urls.extend(source_urls)
+            dead_note_ids.extend(local[name])
+    if missing:
+        info(f"🔗 {len(missing)} local files missing, {redownloaded} notes got theirs downloaded again")
+
+    counts = {"processed": 0, "filled": 0, "transient": 0}
+    if dead_note_ids and not (cancel_event and cancel_event.is_set()):
+        DEAD_IMAGE_URLS.update(dead_urls)
+        if SEARCH_CACHE:
+            SEARCH_CACHE.forget_images(dead_urls)
+        for note_id in dead_note_ids:
+            NOTE_WRITER.add(note_id, {PICTURE_FIELD: ""})
+        # Write the clears now: a clear written after a note's refill would wipe its new picture
+        NOTE_WRITER.flush()
+        groups = plan_note_groups(iter_note_work_items(dead_note_ids, NOTES_PAGE_SIZE))
+        info(f"🔁 Searching again for {len(dead_note_ids)} notes with dead images")
+        if PROGRESS:
+            PROGRESS.total = len(dead_note_ids)
+            PROGRESS.queued = len(groups)
+            PROGRESS.start()
+        with PROFILER.timer("phase:process"):
+            counts = process_groups(groups, cancel_event)
+        counts.pop("retry_ids")
+    close_run_resources()
+
+    summary = {
+        "links": len(status),
+        "links_per_s": round(len(status) / elapsed, 1),
+        "dead_links": dead_links,
+        "unknown_links": unknown,
+        "missing_files": len(missing),
+        "redownloaded": redownloaded,
+        "broken_notes": len(dead_note_ids),
+        "repaired": counts["filled"],
+    }
+    info(
+        f"🔗 Link check done: {len(dead_note_ids)} notes had a broken image, {counts['filled']} got a new one, "
+        f"{redownloaded} were downloaded again"
+    )
+    PROFILER.log_summary(PROFILER.summary())
+    message = (
+        f"Checked {len(status)} links ({summary['links_per_s']}/s): {dead_links} broken"
+        + (f", {len(missing)} local files missing" if missing else "")
+        + f". {counts['filled'] + redownloaded} of {len(dead_note_ids) + redownloaded} broken pictures repaired."
+    )
+    if PROGRESS:
+        PROGRESS.stop(message=message)
+    return summary
+
+def load_watch_mark(path):
+    """Return the Unix time up to which watch mode has already looked at notes, or None."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)["mark"]
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        warning(f"⚠️ Could not read watch state {path}, starting with a full scan: {e}")
+        return None
+
+def save_watch_mark(path, mark):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"mark": mark}, f)
+    os.replace(tmp_path, path)
+
+def watch_deck(cancel_event=None, wake_event=None):
+    """Keep filling the deck's notes as they are added or edited, until cancelled or interrupted.
+
+    Each poll searches only the notes edited since the stored high-water mark
+    (the whole deck when there is none yet) and skips those modified before
+    it, so the cost of a poll depends on what changed, not on the deck size.
+    Notes that failed on provider errors are retried on the next poll. The
+    interval doubles from WATCH_MIN_SECONDS up to WATCH_MAX_SECONDS while
+    nothing changes, and drops back to the minimum when notes turn up or
+    wake_event is set. The local library is rescanned at most every
+    WATCH_MAX_SECONDS, not on every poll. Returns the totals over all polls.
+    """
+    global JOURNAL
+    mark_path = os.path.join(JOURNAL_DIR, f"{job_key()}.watch.json")
+    mark = load_watch_mark(mark_path)
+    wake_event = wake_event or threading.Event()
+    JOURNAL = open_journal()
+    if not open_run_resources():
+        return
+    # open_run_resources just brought the library up to date
+    library_scanned = time.monotonic()
+    if PROGRESS:
+        PROGRESS.start()
+    info(f"👀 Watching deck '{DECK_NAME}' for notes without pictures (every {WATCH_MIN_SECONDS}-{WATCH_MAX_SECONDS}s)")
+
+    totals = {"polls": 0, "processed": 0, "filled": 0, "transient": 0}
+    retry_ids = []
+    interval = WATCH_MIN_SECONDS
+    try:
+        while not (cancel_event and cancel_event.is_set()):
+            polled_at = int(time.time())
+            with PROFILER.timer("phase:watch_poll"):
+                if mark is None:
+                    note_ids = search_anki_for_empty_picture_notes()
+                else:
+                    # Anki's edited:N counts whole days; the mod time check below narrows it down
+                    days = max(1, math.ceil((polled_at - mark) / 86400))
+                    note_ids = search_anki_for_empty_picture_notes(f"edited:{days}")
+            if note_ids is None:
+                # Anki unreachable: keep the mark so nothing edited meanwhile is missed
+                interval = min(interval * 2, WATCH_MAX_SECONDS)
+            else:
+                retrying = set(retry_ids)
+                work_items = chain(
+                    iter_note_work_items(retry_ids, NOTES_PAGE_SIZE),
+                    iter_note_work_items([nid for nid in note_ids if nid not in retrying], NOTES_PAGE_SIZE, since=mark),
+                )
+                groups = plan_note_groups(skip_known_empty(work_items))
+                totals["polls"] += 1
+                retry_ids = []
+                if groups:
+                    # Provider errors from earlier polls should be retried, not replayed from the memo
+                    QUERY_MEMO.clear()
+                    MEDIA_MEMO.clear()
+                    LIBRARY_MEDIA_MEMO.clear()
+                    if LOCAL_LIBRARY and time.monotonic() - library_scanned >= WATCH_MAX_SECONDS:
+                        # Pick up images added to the library; a scan stats every file, so not on every added card
+                        LOCAL_LIBRARY.update()
+                        library_scanned = time.monotonic()
+                    planned_count = sum(len(group["note_ids"]) for group in groups)
+                    info(f"👀 {planned_count} new or edited notes in {len(groups)} groups")
+                    if PROGRESS:
+                        PROGRESS.total += planned_count
+                        PROGRESS.queued += len(groups)
+                    with PROFILER.timer("phase:process"):
+                        counts = process_groups(groups, cancel_event)
+                    NOTE_WRITER.flush()
+                    retry_ids = counts.pop("retry_ids")
+                    for key, value in counts.items():
+                        totals[key] += value
+                    report("watch", **counts)
+                    interval = WATCH_MIN_SECONDS
+                else:
+                    interval = min(interval * 2, WATCH_MAX_SECONDS)
+                mark = polled_at
+                save_watch_mark(mark_path, mark)
+
+            if wake_event.wait(interval):
+                wake_event.clear()
+                interval = WATCH_MIN_SECONDS
+    except KeyboardInterrupt:
+        info("🛑 Watch mode interrupted")
+
+    close_run_resources()
+    info(
+        f"👀 Stopped watching after {totals['polls']} polls: "
+        f"updated {totals['filled']}/{totals['processed']} notes, {totals['transient']} failed"
+    )
+    PROFILER.log_summary(PROFILER.summary())
+    if PROGRESS:
+        PROGRESS.stop()
+    return totals
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        stop_logging()